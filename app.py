@@ -1,138 +1,2617 @@
+import time
+
+# Taken before the heavy imports so time-to-ready includes them
+BOOT_STARTED = time.perf_counter()
+
 import discord
 from discord.ext import commands
 import aiohttp
+import argparse
 import json
 import asyncio
+import copy
+import hashlib
+import math
 import os
+import random
+import re
+import sqlite3
+import sys
+from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
 from typing import Dict, List, Optional, Tuple
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 from dotenv import load_dotenv
 import logging
 
-# Load environment variables
-load_dotenv()
+IMPORTS_DONE = time.perf_counter()
+
+# Load environment variables
+load_dotenv()
+
+# Setup logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+# Metrics
+# Labels added to every series recorded from the current task, e.g. the
+# character a bot serves when several run in one process
+metric_labels: ContextVar[Optional[Dict[str, str]]] = ContextVar('metric_labels', default=None)
+
+
+class Metrics:
+    """In-process counters, gauges and timing samples
+
+    Each series is keyed by name plus optional labels, e.g.
+    metrics.incr('api_requests_total', model='gpt-4o').
+    """
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, max_samples: int = 1000):
+        self.max_samples = max_samples
+        self.counters: Dict[Tuple, float] = defaultdict(float)
+        self.gauges: Dict[Tuple, float] = {}
+        self.samples: Dict[Tuple, deque] = {}
+        # Lifetime count and sum per sample series, for Prometheus summaries
+        self.totals: Dict[Tuple, List[float]] = {}
+
+    @staticmethod
+    def _key(name: str, labels: Dict) -> Tuple:
+        context = metric_labels.get()
+        if context:
+            labels = {**context, **labels}
+        return (name, tuple(sorted(labels.items())))
+
+    def incr(self, name: str, value: float = 1, **labels) -> None:
+        self.counters[self._key(name, labels)] += value
+
+    def set_gauge(self, name: str, value: float, **labels) -> None:
+        self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = self._key(name, labels)
+        if key not in self.samples:
+            self.samples[key] = deque(maxlen=self.max_samples)
+            self.totals[key] = [0, 0.0]
+        self.samples[key].append(value)
+        totals = self.totals[key]
+        totals[0] += 1
+        totals[1] += value
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Observe the wall time spent inside the block, in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def quantiles(values, quantiles=QUANTILES) -> List[float]:
+        """Nearest-rank quantiles of the recent samples"""
+        ordered = sorted(values)
+        if not ordered:
+            return [0.0 for _ in quantiles]
+        return [ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in quantiles]
+
+    @staticmethod
+    def _format_labels(labels, extra: Tuple = ()) -> str:
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = []
+        for name, value in pairs:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped.append(f'{name}="{value}"')
+        return '{' + ','.join(escaped) + '}'
+
+    def render_prometheus(self) -> str:
+        """All series in the Prometheus text exposition format"""
+        lines = []
+        for kind, series in (('counter', self.counters), ('gauge', self.gauges)):
+            typed = set()
+            for (name, labels), value in sorted(series.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} {kind}")
+                    typed.add(name)
+                lines.append(f"{name}{self._format_labels(labels)} {value}")
+        typed = set()
+        for (name, labels), values in sorted(self.samples.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} summary")
+                typed.add(name)
+            for q, value in zip(self.QUANTILES, self.quantiles(values)):
+                lines.append(f"{name}{self._format_labels(labels, (('quantile', q),))} {value}")
+            count, total = self.totals[(name, labels)]
+            lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {total}")
+        return '\n'.join(lines) + '\n'
+
+
+async def start_metrics_server(port: int, host: str = '127.0.0.1'):
+    """Serve metrics.render_prometheus() at http://host:port/metrics"""
+    # aiohttp.web is only needed when metrics are served; keep it off the boot path
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=metrics.render_prometheus(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
+
+
+metrics = Metrics()
+
+# File I/O
+# orjson is several times faster than the json module; use it when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_dumps(data, pretty: bool = False) -> bytes:
+    """Encode JSON as UTF-8 bytes with the fastest available codec"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if pretty else 0)
+    if pretty:
+        return json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8')
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def json_loads(raw):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def read_json_file(path: str):
+    with open(path, 'rb') as f:
+        return json_loads(f.read())
+
+
+def write_file_atomic(path: str, payload: bytes) -> None:
+    """Write to a temp file and rename it over the target, so readers never see half a file"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def iter_lines_backward(path: str, block_size: int = 65536):
+    """Yield a file's non-empty lines from last to first, reading it in blocks from the end"""
+    with open(path, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        rest = b''
+        while position > 0:
+            step = min(block_size, position)
+            position -= step
+            f.seek(position)
+            lines = (f.read(step) + rest).split(b'\n')
+            # The first piece may continue in the previous block
+            rest = lines.pop(0)
+            for line in reversed(lines):
+                if line:
+                    yield line
+        if rest:
+            yield rest
+
+
+class AsyncJsonWriter:
+    """Save a JSON file from a worker thread, coalescing bursts of saves
+
+    save() marks the file dirty and schedules a write after `delay`
+    seconds; any further saves in that window are folded into the same
+    write. snapshot() runs on the event loop and should return a cheap
+    copy of the data, which is then encoded and written off the loop.
+    """
+
+    def __init__(self, path: str, snapshot, delay: float = 0.5, pretty: bool = False):
+        self.path = path
+        self.snapshot = snapshot
+        self.delay = delay
+        self.pretty = pretty
+        self._dirty = False
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def _write(self, data) -> None:
+        write_file_atomic(self.path, json_dumps(data, self.pretty))
+
+    def save(self) -> None:
+        self._dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (command-line tools): write straight away
+            self._dirty = False
+            self._write(self.snapshot())
+            return
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while self._dirty:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._dirty = False
+                data = self.snapshot()
+                start = time.monotonic()
+                await loop.run_in_executor(None, self._write, data)
+                metrics.observe('file_write_seconds', time.monotonic() - start, file=os.path.basename(self.path))
+        except Exception as e:
+            logger.error(f"Failed to save {self.path}: {e}")
+        finally:
+            self._task = None
+
+    async def flush(self) -> None:
+        """Write any pending changes now"""
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+
+
+class RecordLog:
+    """An append-only JSON-lines file, written behind from a background task
+
+    append() queues a record; the queue is written and fsynced every
+    flush_interval seconds, or sooner once flush_batch records are waiting,
+    so a crash loses at most one batch. replay() reads the file back,
+    skipping lines a crash tore, and rewrites it without them so new
+    records never land on a half-written line. With a snapshot function,
+    the file is compacted into snapshot()'s records once it holds more
+    than compact_ratio times live() lines. Logs that are only ever read
+    from the end can call recover() instead of replay() and set max_bytes
+    to be rotated to <path>.1 when they reach that size. Nothing is
+    written until the file has been replayed or recovered.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 2.0, flush_batch: int = 64,
+                 snapshot=None, live=None, compact_ratio: float = 4.0, max_bytes: int = 0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.snapshot = snapshot
+        self.live = live
+        self.compact_ratio = compact_ratio
+        self.replayed = False
+        self._lines = 0
+        self._pending: List[bytes] = []
+        self._lock: Optional[asyncio.Lock] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    def replay(self, apply) -> None:
+        """Pass every intact record in the file to apply (runs on a worker thread)"""
+        corrupt = False
+        self._lines = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    self._lines += 1
+                    # Binary mode: a torn line can end inside a multibyte character
+                    if not line.endswith(b'\n'):
+                        corrupt = True
+                    try:
+                        apply(json_loads(line))
+                    except (KeyError, TypeError, ValueError):
+                        logger.warning(f"Skipping corrupt record in {self.path} (line {self._lines})")
+                        corrupt = True
+        if corrupt:
+            self._drop_corrupt()
+        self.replayed = True
+
+    def _drop_corrupt(self) -> None:
+        lines = []
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    json_loads(line)
+                except ValueError:
+                    continue
+                lines.append(line if line.endswith(b'\n') else line + b'\n')
+        self.rewrite(lines)
+
+    def recover(self) -> None:
+        """Cut a torn final line off the file without reading the rest (runs on a worker thread)"""
+        if os.path.exists(self.path):
+            with open(self.path, 'rb+') as f:
+                end = position = f.seek(0, os.SEEK_END)
+                while position > 0:
+                    step = min(65536, position)
+                    position -= step
+                    f.seek(position)
+                    block = f.read(step)
+                    if position + step == end and block.endswith(b'\n'):
+                        break
+                    newline = block.rfind(b'\n')
+                    if newline != -1:
+                        f.truncate(position + newline + 1)
+                        logger.warning(f"Dropped a torn record at the end of {self.path}")
+                        break
+                else:
+                    f.truncate(0)
+        self.replayed = True
+
+    def rewrite(self, lines: List[bytes]) -> None:
+        """Atomically replace the file with these encoded records"""
+        write_file_atomic(self.path, b''.join(lines))
+        self._lines = len(lines)
+
+    @staticmethod
+    def encode(record: Dict) -> bytes:
+        return json_dumps(record) + b'\n'
+
+    def append(self, record: Dict) -> None:
+        self._pending.append(self.encode(record))
+        if len(self._pending) >= self.flush_batch and self._wakeup:
+            self._wakeup.set()
+
+    def _append_lines(self, lines: List[bytes]) -> None:
+        with open(self.path, 'ab') as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        self._lines += len(lines)
+        if self.max_bytes and size >= self.max_bytes:
+            os.replace(self.path, self.path + '.1')
+            self._lines = 0
+            logger.info(f"Rotated {self.path} at {size} bytes")
+
+    async def flush(self) -> None:
+        """Write queued records, compacting the file when it has grown stale"""
+        if not self.replayed:
+            # Compacting now would overwrite the file with a partial snapshot
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            if self.snapshot and self._lines + len(self._pending) > max(self.live() * self.compact_ratio, 1000):
+                # The snapshot already contains every queued record. Build it on
+                # the loop, then encode and write it on a worker thread
+                self._pending = []
+                records = self.snapshot()
+                await loop.run_in_executor(None, lambda: self.rewrite([self.encode(r) for r in records]))
+            elif self._pending:
+                lines, self._pending = self._pending, []
+                await loop.run_in_executor(None, self._append_lines, lines)
+
+    async def _flush_loop(self) -> None:
+        # Stopped with a flag rather than cancel(): on Python 3.11 wait_for can
+        # swallow a cancellation that arrives together with its timeout
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Flushing {self.path} failed: {e}")
+
+    def start(self) -> None:
+        if self._flush_task is None:
+            self._wakeup = asyncio.Event()
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        if self._flush_task:
+            self._closing = True
+            self._wakeup.set()
+            await self._flush_task
+            self._flush_task = None
+        await self.flush()
+
+
+class BackgroundLoad(ABC):
+    """Mixin for stores that read their file on a worker thread, off the startup path
+
+    start_loading() begins _read() in the background; every method that
+    needs the data awaits ensure_loaded() first. Whatever _read() returns
+    is passed to _finish_load() back on the event loop.
+    """
+
+    _loaded = False
+    _load_task: Optional[asyncio.Task] = None
+
+    @abstractmethod
+    def _read(self):
+        """Read the store's file (runs on a worker thread)"""
+        pass
+
+    def _finish_load(self, result) -> None:
+        pass
+
+    def _loaded_summary(self) -> str:
+        return type(self).__name__
+
+    async def _load(self) -> None:
+        started = time.perf_counter()
+        result = await asyncio.get_running_loop().run_in_executor(None, self._read)
+        self._finish_load(result)
+        self._loaded = True
+        logger.info(f"Loaded {self._loaded_summary()} in {time.perf_counter() - started:.2f}s")
+
+    def start_loading(self) -> None:
+        if self._load_task is None:
+            self._load_task = asyncio.create_task(self._load())
+
+    async def ensure_loaded(self) -> None:
+        if not self._loaded:
+            self.start_loading()
+            await self._load_task
+
+
+class LoopLagMonitor:
+    """Measure how late the event loop wakes up from a fixed sleep
+
+    Anything that blocks the loop (file I/O, heavy JSON, CPU work) shows
+    up as lag, recorded as event_loop_lag_seconds and logged when it
+    passes warn_threshold.
+    """
+
+    def __init__(self, interval: float = 0.5, warn_threshold: float = 0.1):
+        self.interval = interval
+        self.warn_threshold = warn_threshold
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            metrics.observe('event_loop_lag_seconds', lag)
+            if lag > self.warn_threshold:
+                logger.warning(f"Event loop blocked for {lag * 1000:.0f}ms")
+
+
+# Memory interface
+
+class MemoryInterface(ABC):
+    """Abstract base class for memory systems"""
+    
+    @abstractmethod
+    async def get_memories(self, user_id: int, limit: int = 20) -> List[Dict]:
+        pass
+    
+    @abstractmethod
+    async def add_memory(self, user_id: int, role: str, content: str) -> None:
+        pass
+    
+    @abstractmethod
+    async def clear_memories(self, user_id: int) -> None:
+        pass
+
+    async def replace_last_memory(self, user_id: int, role: str, old: str, new: str) -> bool:
+        """Swap the newest entry for new if it is still role/old, e.g. a regenerated reply
+
+        Returns False without changing anything otherwise. This default
+        rewrites the whole history; backends should override it.
+        """
+        history = await self.get_memories(user_id, limit=getattr(self, 'max_history', 50))
+        if not history or history[-1] != {"role": role, "content": old}:
+            return False
+        await self.clear_memories(user_id)
+        for entry in history[:-1]:
+            await self.add_memory(user_id, entry['role'], entry['content'])
+        await self.add_memory(user_id, role, new)
+        return True
+
+    async def start(self) -> None:
+        """Start background work (called once the event loop is running)"""
+        pass
+
+    async def close(self) -> None:
+        """Flush pending writes and stop background work"""
+        pass
+
+
+class InMemoryHistory(BackgroundLoad, MemoryInterface):
+    """Base for backends that hold every history in RAM, read from one file
+
+    Reading starts on a worker thread at start() without holding up the
+    gateway connection; the first access waits for it to finish.
+    """
+
+    memories: Dict[int, List]
+
+    def _loaded_summary(self) -> str:
+        return f"history for {len(self.memories)} users"
+
+    async def start(self) -> None:
+        self.start_loading()
+
+
+class LocalMemory(InMemoryHistory):
+    """Local JSON file storage for fps.ms compatibility"""
+    
+    def __init__(self, character_name: str = "bot", max_history: int = 50):
+        self.character_name = character_name.lower().replace(" ", "_")
+        self.memory_file = f"memories_{self.character_name}.json"
+        self.max_history = max_history
+        self.memories: Dict[int, List] = {}
+        self._writer = AsyncJsonWriter(self.memory_file, self._snapshot)
+    
+    def _read(self) -> None:
+        self.memories = self._load_memories()
+    
+    def _load_memories(self) -> Dict[int, List]:
+        """Load memories from JSON file"""
+        try:
+            data = read_json_file(self.memory_file)
+            return {int(k): v for k, v in data.items()}
+        except (FileNotFoundError, ValueError):
+            return {}
+    
+    def _snapshot(self) -> Dict[str, List]:
+        # Entries are never mutated once added, so copying the lists is enough
+        return {str(k): list(v) for k, v in self.memories.items()}
+    
+    def _save_memories(self) -> None:
+        """Save memories to JSON file (coalesced and written off the event loop)"""
+        self._writer.save()
+    
+    async def close(self) -> None:
+        await self._writer.flush()
+    
+    async def get_memories(self, user_id: int, limit: int = 20) -> List[Dict]:
+        await self.ensure_loaded()
+        if user_id not in self.memories:
+            return []
+        return self.memories[user_id][-limit:]
+    
+    async def add_memory(self, user_id: int, role: str, content: str) -> None:
+        await self.ensure_loaded()
+        if user_id not in self.memories:
+            self.memories[user_id] = []
+        
+        self.memories[user_id].append({"role": role, "content": content})
+        
+        if len(self.memories[user_id]) > self.max_history:
+            self.memories[user_id] = self.memories[user_id][-self.max_history:]
+        
+        self._save_memories()
+    
+    async def replace_last_memory(self, user_id: int, role: str, old: str, new: str) -> bool:
+        await self.ensure_loaded()
+        history = self.memories.get(user_id)
+        if not history or history[-1] != {"role": role, "content": old}:
+            return False
+        history[-1] = {"role": role, "content": new}
+        self._save_memories()
+        return True
+    
+    async def clear_memories(self, user_id: int) -> None:
+        await self.ensure_loaded()
+        if user_id in self.memories:
+            self.memories[user_id] = []
+            self._save_memories()
+
+
+class AppendLogMemory(InMemoryHistory):
+    """Append-only log storage with write-behind flushing
+
+    Every change is one JSON line appended to memories_<name>.log. Lines are
+    buffered and written from a background task, and the log is compacted
+    into a fresh snapshot once it holds far more lines than live entries.
+    """
+
+    def __init__(self, character_name: str = "bot", max_history: int = 50,
+                 flush_interval: float = 2.0, flush_batch: int = 64, compact_ratio: float = 4.0):
+        self.character_name = character_name.lower().replace(" ", "_")
+        self.log_file = f"memories_{self.character_name}.log"
+        self.legacy_file = f"memories_{self.character_name}.json"
+        self.max_history = max_history
+        self.memories: Dict[int, List] = {}
+        self._log = RecordLog(self.log_file, flush_interval, flush_batch, snapshot=self._snapshot,
+                              live=lambda: sum(len(history) for history in self.memories.values()),
+                              compact_ratio=compact_ratio)
+
+    def _apply(self, record: Dict) -> None:
+        """Apply a single log record to the in-memory state"""
+        user_id = int(record['u'])
+        if record.get('op') == 'clear':
+            self.memories[user_id] = []
+            return
+        history = self.memories.setdefault(user_id, [])
+        if record.get('op') == 'replace':
+            if history:
+                history[-1] = {"role": record['r'], "content": record['c']}
+            return
+        history.append({"role": record['r'], "content": record['c']})
+        if len(history) > self.max_history:
+            del history[:-self.max_history]
+
+    def _snapshot(self) -> List[Dict]:
+        """Records that rebuild the current state"""
+        return [{"u": user_id, "r": entry['role'], "c": entry['content']}
+                for user_id, history in self.memories.items() for entry in history]
+
+    def _read(self) -> None:
+        self._load_log()
+
+    def _load_log(self) -> None:
+        """Replay the log file, importing the legacy JSON file on first run"""
+        if not os.path.exists(self.log_file) and os.path.exists(self.legacy_file):
+            try:
+                data = read_json_file(self.legacy_file)
+                self._log.rewrite([RecordLog.encode({"u": int(user_id), "r": entry['role'], "c": entry['content']})
+                                   for user_id, history in data.items() for entry in history[-self.max_history:]])
+                logger.info(f"Imported {len(data)} users from {self.legacy_file}")
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.error(f"Could not import {self.legacy_file}: {e}")
+        self._log.replay(self._apply)
+
+    def _record(self, record: Dict) -> None:
+        self._apply(record)
+        self._log.append(record)
+
+    async def flush(self) -> None:
+        """Write buffered records, compacting the log when it has grown stale"""
+        await self._log.flush()
+
+    async def start(self) -> None:
+        await super().start()
+        self._log.start()
+
+    async def close(self) -> None:
+        if self._load_task:
+            # Don't write anything until the log has been read
+            await self._load_task
+        await self._log.close()
+
+    async def get_memories(self, user_id: int, limit: int = 20) -> List[Dict]:
+        await self.ensure_loaded()
+        if user_id not in self.memories:
+            return []
+        return self.memories[user_id][-limit:]
+
+    async def add_memory(self, user_id: int, role: str, content: str) -> None:
+        await self.ensure_loaded()
+        self._record({"u": user_id, "r": role, "c": content})
+
+    async def replace_last_memory(self, user_id: int, role: str, old: str, new: str) -> bool:
+        await self.ensure_loaded()
+        history = self.memories.get(user_id)
+        if not history or history[-1] != {"role": role, "content": old}:
+            return False
+        self._record({"u": user_id, "op": "replace", "r": role, "c": new})
+        return True
+
+    async def clear_memories(self, user_id: int) -> None:
+        await self.ensure_loaded()
+        if user_id in self.memories:
+            self._record({"u": user_id, "op": "clear"})
+
+
+class SqliteStore:
+    """A SQLite database in WAL mode, owned by a single worker thread
+
+    All queries run on the worker thread that holds the connection. Writes
+    are visible to reads immediately and committed in batches by a
+    background task. With commit_batch 1 every write is committed as it
+    is made instead, so other processes sharing the file are never kept
+    waiting on an open transaction. One store can back several
+    SqliteMemory namespaces.
+    """
+
+    def __init__(self, db_file: str, commit_interval: float = 1.0, commit_batch: int = 64,
+                 busy_timeout: float = 5.0):
+        self.db_file = db_file
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        self.busy_timeout = busy_timeout
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"sqlite-{os.path.basename(db_file)}")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._uncommitted = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._commit_task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    def connect(self) -> sqlite3.Connection:
+        """Open the database on the worker thread and create the schema"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=self.busy_timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS memories (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                character TEXT NOT NULL DEFAULT ''
+            )""")
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(memories)")]
+            if 'character' not in columns:
+                # Databases created before namespaces were added
+                conn.execute("ALTER TABLE memories ADD COLUMN character TEXT NOT NULL DEFAULT ''")
+            conn.execute("DROP INDEX IF EXISTS idx_memories_user")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_memories_character_user ON memories (character, user_id, id)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _write(self, func, *args):
+        result = func(*args)
+        if self.commit_batch <= 1:
+            self._conn.commit()
+        return result
+
+    async def write(self, func, *args):
+        """Run a write on the worker thread, committing it there if writes aren't batched"""
+        return await self.run(self._write, func, *args)
+
+    def mark_dirty(self) -> None:
+        if self.commit_batch <= 1:
+            # Already committed by write()
+            return
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_batch and self._wakeup:
+            self._wakeup.set()
+
+    def _commit(self) -> None:
+        if self._conn is not None:
+            self._conn.commit()
+
+    def _close_conn(self) -> None:
+        if self._conn is not None:
+            self._conn.commit()
+            self._conn.close()
+            self._conn = None
+
+    async def flush(self) -> None:
+        """Commit any outstanding writes"""
+        if self._uncommitted:
+            self._uncommitted = 0
+            await self.run(self._commit)
+
+    async def _commit_loop(self) -> None:
+        # Stopped with a flag for the same reason as AppendLogMemory._flush_loop
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.commit_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Memory commit failed: {e}")
+
+    async def start(self) -> None:
+        if self._commit_task is None:
+            self._wakeup = asyncio.Event()
+            self._commit_task = asyncio.create_task(self._commit_loop())
+
+    async def close(self) -> None:
+        if self._commit_task:
+            self._closing = True
+            self._wakeup.set()
+            await self._commit_task
+            self._commit_task = None
+        await self.run(self._close_conn)
+        self._executor.shutdown(wait=True)
+
+
+class SqliteMemory(MemoryInterface):
+    """SQLite-backed memory, queried off the event loop
+
+    By default each character gets its own memories_<name>.db. When a
+    shared SqliteStore is passed in, rows are namespaced by character so
+    several bots can share one database without seeing each other's history.
+    Histories are read on first use and the newest cache_users are kept
+    in an LRU; writes go through to the database, so eviction just drops them.
+    """
+
+    def __init__(self, character_name: str = "bot", max_history: int = 50,
+                 commit_interval: float = 1.0, commit_batch: int = 64,
+                 store: Optional[SqliteStore] = None, cache_users: int = 256, busy_timeout: float = 5.0):
+        self.character_name = character_name.lower().replace(" ", "_")
+        self.max_history = max_history
+        self.cache_users = cache_users
+        self.hot: "OrderedDict[int, List[Dict]]" = OrderedDict()
+        self._owns_store = store is None
+        if store is None:
+            store = SqliteStore(f"memories_{self.character_name}.db", commit_interval, commit_batch, busy_timeout)
+        self.store = store
+        self.db_file = store.db_file
+        # A private database needs no namespace
+        self.namespace = '' if self._owns_store else self.character_name
+
+    def _select(self, user_id: int, limit: int) -> List[Dict]:
+        rows = self.store.connect().execute(
+            "SELECT role, content FROM memories WHERE character = ? AND user_id = ? ORDER BY id DESC LIMIT ?",
+            (self.namespace, user_id, limit)
+        ).fetchall()
+        return [{"role": role, "content": content} for role, content in reversed(rows)]
+
+    def _insert(self, user_id: int, role: str, content: str) -> None:
+        conn = self.store.connect()
+        conn.execute(
+            "INSERT INTO memories (user_id, role, content, character) VALUES (?, ?, ?, ?)",
+            (user_id, role, content, self.namespace)
+        )
+        # Retention: drop everything older than the newest max_history rows
+        conn.execute(
+            """DELETE FROM memories WHERE character = ? AND user_id = ? AND id <= (
+                SELECT id FROM memories WHERE character = ? AND user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?
+            )""",
+            (self.namespace, user_id, self.namespace, user_id, self.max_history)
+        )
+
+    def _replace_last(self, user_id: int, role: str, old: str, new: str) -> bool:
+        conn = self.store.connect()
+        row = conn.execute(
+            "SELECT id, role, content FROM memories WHERE character = ? AND user_id = ? ORDER BY id DESC LIMIT 1",
+            (self.namespace, user_id)
+        ).fetchone()
+        if row is None or row[1] != role or row[2] != old:
+            return False
+        conn.execute("UPDATE memories SET content = ? WHERE id = ?", (new, row[0]))
+        return True
+
+    def _delete(self, user_id: int) -> None:
+        self.store.connect().execute(
+            "DELETE FROM memories WHERE character = ? AND user_id = ?", (self.namespace, user_id)
+        )
+
+    async def flush(self) -> None:
+        await self.store.flush()
+
+    async def start(self) -> None:
+        await self.store.start()
+
+    async def close(self) -> None:
+        if self._owns_store:
+            await self.store.close()
+        else:
+            await self.store.flush()
+
+    async def get_memories(self, user_id: int, limit: int = 20) -> List[Dict]:
+        history = self.hot.get(user_id)
+        if history is not None:
+            self.hot.move_to_end(user_id)
+            metrics.incr('memory_cache_total', result='hit')
+            return history[-limit:]
+        if not self.cache_users:
+            return await self.store.run(self._select, user_id, limit)
+        metrics.incr('memory_cache_total', result='miss')
+        history = await self.store.run(self._select, user_id, self.max_history)
+        self.hot[user_id] = history
+        while len(self.hot) > self.cache_users:
+            self.hot.popitem(last=False)
+        return history[-limit:]
+
+    async def add_memory(self, user_id: int, role: str, content: str) -> None:
+        await self.store.write(self._insert, user_id, role, content)
+        self.store.mark_dirty()
+        history = self.hot.get(user_id)
+        if history is not None:
+            history.append({"role": role, "content": content})
+            del history[:-self.max_history]
+
+    async def replace_last_memory(self, user_id: int, role: str, old: str, new: str) -> bool:
+        replaced = await self.store.write(self._replace_last, user_id, role, old, new)
+        if replaced:
+            self.store.mark_dirty()
+            self.hot.pop(user_id, None)
+        return replaced
+
+    async def clear_memories(self, user_id: int) -> None:
+        await self.store.write(self._delete, user_id)
+        self.store.mark_dirty()
+        self.hot.pop(user_id, None)
+
+
+def create_memory_system(character_data: Dict, shared_store: Optional[SqliteStore] = None) -> MemoryInterface:
+    """Create the memory backend selected by memory_system.type
+
+    When a shared store is given (multi-character hosting) every character
+    keeps its history there, namespaced by character name.
+    """
+    config = character_data.get('memory_system', {})
+    name = character_data['profile']['name']
+    memory_type = config.get('type', 'standard')
+    max_history = int(config.get('max_history', 50))
+    cache_users = int(config.get('cache_users', 256))
+
+    if shared_store is not None:
+        return SqliteMemory(name, max_history=max_history, store=shared_store, cache_users=cache_users)
+    if memory_type == 'append_log':
+        return AppendLogMemory(
+            name,
+            max_history=max_history,
+            flush_interval=float(config.get('flush_interval', 2.0)),
+            flush_batch=int(config.get('flush_batch', 64)),
+            compact_ratio=float(config.get('compact_ratio', 4.0))
+        )
+    if memory_type == 'sqlite':
+        return SqliteMemory(
+            name,
+            max_history=max_history,
+            commit_interval=float(config.get('flush_interval', 1.0)),
+            commit_batch=int(config.get('flush_batch', 64)),
+            cache_users=cache_users,
+            busy_timeout=float(config.get('busy_timeout', 5.0))
+        )
+    if memory_type != 'standard':
+        logger.warning(f"Unknown memory_system.type '{memory_type}', using standard")
+    return LocalMemory(name, max_history=max_history)
+
+
+async def migrate_json_memories(character_data: Dict, shared_store: Optional[SqliteStore] = None) -> int:
+    """Import memories_<name>.json into the configured memory backend"""
+    memory = create_memory_system(character_data, shared_store)
+    if isinstance(memory, LocalMemory):
+        logger.error("memory_system.type is 'standard'; nothing to migrate to")
+        return 0
+
+    legacy = LocalMemory(character_data['profile']['name'])
+    await legacy.ensure_loaded()
+    await memory.start()
+    imported = 0
+    try:
+        for user_id, history in legacy.memories.items():
+            await memory.clear_memories(user_id)
+            for entry in history[-memory.max_history:]:
+                await memory.add_memory(user_id, entry['role'], entry['content'])
+                imported += 1
+    finally:
+        await memory.close()
+    logger.info(f"Migrated {imported} entries for {len(legacy.memories)} users from {legacy.memory_file}")
+    return imported
+
+
+# Long-term memory
+STOPWORDS = frozenset("""a an and are as at be but by did do for from had has have he her him his i if in is it its
+me my no not of on or our she so that the their them then there they this to was we were what when
+where which who will with you your""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    return [word for word in re.findall(r"\w+", text.lower()) if len(word) > 1 and word not in STOPWORDS]
+
+
+class LexicalIndex:
+    """Okapi BM25 over one user's past exchanges, updated a document at a time
+
+    Documents are numbered in the order they were added, so "everything
+    before seq n" is a cheap filter for leaving out what is still in the
+    verbatim history.
+    """
+
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self):
+        self.docs: "OrderedDict[int, Tuple[str, Dict[str, int]]]" = OrderedDict()
+        self.postings: Dict[str, set] = defaultdict(set)
+        self.total_length = 0
+        self.next_seq = 0
+
+    def add(self, text: str, seq: Optional[int] = None) -> int:
+        """Add a document, replacing any existing one with the same seq"""
+        if seq is None:
+            seq = self.next_seq
+        elif seq in self.docs:
+            self.remove(seq)
+        self.next_seq = max(self.next_seq, seq + 1)
+        terms: Dict[str, int] = {}
+        for term in tokenize(text):
+            terms[term] = terms.get(term, 0) + 1
+        self.docs[seq] = (text, terms)
+        for term in terms:
+            self.postings[term].add(seq)
+        self.total_length += sum(terms.values())
+        return seq
+
+    def remove(self, seq: int) -> None:
+        _, terms = self.docs.pop(seq)
+        for term in terms:
+            postings = self.postings[term]
+            postings.discard(seq)
+            if not postings:
+                del self.postings[term]
+        self.total_length -= sum(terms.values())
+
+    def search(self, query: str, limit: int = 3, before: Optional[int] = None) -> List[Tuple[int, str]]:
+        """Best-scoring documents for the query, oldest first, optionally only those before seq"""
+        if not self.docs:
+            return []
+        count = len(self.docs)
+        average_length = self.total_length / count or 1
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for seq in postings:
+                if before is not None and seq >= before:
+                    continue
+                terms = self.docs[seq][1]
+                tf = terms[term]
+                length = sum(terms.values())
+                scores[seq] += idf * tf * (self.K1 + 1) / (tf + self.K1 * (1 - self.B + self.B * length / average_length))
+        best = sorted(scores, key=scores.get, reverse=True)[:limit]
+        return [(seq, self.docs[seq][0]) for seq in sorted(best)]
+
+
+class LongTermMemory(BackgroundLoad):
+    """Older conversation kept as per-user summaries and a searchable archive
+
+    Every exchange is archived in a per-user LexicalIndex (the newest
+    max_documents are kept) so relevant old ones can be recalled into the
+    prompt. Exchanges that have left the verbatim history are folded into
+    a rolling summary in batches. Both are stored as an append-only log,
+    longterm_<name>.log, next to the memory store and compacted when it
+    grows stale. Shard worker processes each keep their own log
+    (longterm_<name>.worker<n>.log), since compacting rewrites the file
+    from one process's state.
+    """
+
+    def __init__(self, character_name: str = "bot", max_documents: int = 500,
+                 flush_interval: float = 2.0, compact_ratio: float = 4.0, worker: Optional[int] = None):
+        self.character_name = character_name.lower().replace(" ", "_")
+        suffix = f".worker{worker}" if worker is not None else ""
+        self.path = f"longterm_{self.character_name}{suffix}.log"
+        self.max_documents = max_documents
+        self.indexes: Dict[int, LexicalIndex] = {}
+        # user_id -> (first seq not yet summarized, summary)
+        self.summaries: Dict[int, Tuple[int, str]] = {}
+        self._log = RecordLog(self.path, flush_interval, snapshot=self._snapshot,
+                              live=lambda: self.document_count + len(self.summaries),
+                              compact_ratio=compact_ratio)
+
+    def _apply(self, record: Dict) -> None:
+        user_id = int(record['u'])
+        op = record.get('op')
+        if op == 'clear':
+            self.indexes.pop(user_id, None)
+            self.summaries.pop(user_id, None)
+            return
+        if op == 'summary':
+            self.summaries[user_id] = (record['n'], record['s'])
+            return
+        index = self.indexes.setdefault(user_id, LexicalIndex())
+        index.add(record['d'], record['n'])
+        while len(index.docs) > self.max_documents:
+            index.remove(next(iter(index.docs)))
+
+    def _record(self, record: Dict) -> None:
+        self._apply(record)
+        self._log.append(record)
+
+    def _snapshot(self) -> List[Dict]:
+        """Records that rebuild the current state"""
+        records = []
+        for user_id, index in self.indexes.items():
+            records.extend({"u": user_id, "n": seq, "d": text} for seq, (text, _) in index.docs.items())
+        for user_id, (covered, summary) in self.summaries.items():
+            records.append({"u": user_id, "op": "summary", "n": covered, "s": summary})
+        return records
+
+    def add_exchange(self, user_id: int, user_text: str, reply: str, replace: bool = False) -> None:
+        """Archive one exchange; replace swaps out the newest one (a regenerated reply)"""
+        seq = self.next_seq(user_id)
+        if replace and seq:
+            seq -= 1
+        self._record({"u": user_id, "n": seq, "d": f"User: {user_text}\nYou: {reply}"})
+
+    def seed(self, user_id: int, history: List[Dict]) -> None:
+        """Archive history kept from before the long-term tier was enabled"""
+        if user_id in self.indexes:
+            return
+        self.indexes[user_id] = LexicalIndex()
+        for first, second in zip(history, history[1:]):
+            if first['role'] == 'user' and second['role'] == 'assistant':
+                self.add_exchange(user_id, first['content'], second['content'])
+
+    def clear(self, user_id: int) -> None:
+        if user_id in self.indexes or user_id in self.summaries:
+            self._record({"u": user_id, "op": "clear"})
+
+    def next_seq(self, user_id: int) -> int:
+        index = self.indexes.get(user_id)
+        return index.next_seq if index else 0
+
+    def search(self, user_id: int, query: str, limit: int, before: int) -> List[str]:
+        index = self.indexes.get(user_id)
+        return [text for _, text in index.search(query, limit, before)] if index else []
+
+    def summary(self, user_id: int) -> Optional[str]:
+        entry = self.summaries.get(user_id)
+        return entry[1] if entry else None
+
+    def unsummarized(self, user_id: int, before: int) -> List[Tuple[int, str]]:
+        """Archived exchanges older than seq before that the summary doesn't cover yet"""
+        index = self.indexes.get(user_id)
+        if not index:
+            return []
+        covered = self.summaries.get(user_id, (0, ""))[0]
+        return [(seq, text) for seq, (text, _) in index.docs.items() if covered <= seq < before]
+
+    def set_summary(self, user_id: int, covered: int, summary: str) -> None:
+        self._record({"u": user_id, "op": "summary", "n": covered, "s": summary})
+
+    @property
+    def document_count(self) -> int:
+        return sum(len(index.docs) for index in self.indexes.values())
+
+    async def flush(self) -> None:
+        """Write pending records, compacting the log once it is mostly dead records"""
+        await self._log.flush()
+
+    def _read(self) -> None:
+        self._log.replay(self._apply)
+
+    def _loaded_summary(self) -> str:
+        return f"{self.document_count} archived exchanges"
+
+    async def start(self) -> None:
+        """Start reading the archive; callers await ensure_loaded() before using it"""
+        self.start_loading()
+        self._log.start()
+
+    async def close(self) -> None:
+        if self._load_task:
+            await self._load_task
+        await self._log.close()
+
+
+# Custom commands
+class CommandIndex:
+    """Hash-based dispatch table for knowledge.commands
+
+    Each command matches on "exact" text (the default), as a "prefix", or
+    as a "regex", and may list extra "aliases" triggers. Exact and prefix
+    triggers are matched case-insensitively with dict lookups; messages
+    whose first character can't start any trigger are rejected up front.
+    """
+
+    def __init__(self, commands: List[Dict]):
+        self.exact: Dict[str, str] = {}
+        self.prefixes: List[Tuple[int, Dict[str, str]]] = []
+        self.patterns: List[Tuple["re.Pattern", str]] = []
+        self.first_chars = set()
+
+        prefix_tables: Dict[int, Dict[str, str]] = {}
+        for cmd in commands:
+            response = cmd.get('response')
+            if not response or not cmd.get('command'):
+                continue
+            match = cmd.get('match', 'exact')
+            triggers = [cmd['command']] + list(cmd.get('aliases', []))
+            for trigger in triggers:
+                if match == 'regex':
+                    try:
+                        self.patterns.append((re.compile(trigger, re.IGNORECASE), response))
+                    except re.error as e:
+                        logger.error(f"Invalid regex for custom command {trigger!r}: {e}")
+                    continue
+                trigger = trigger.lower()
+                if not trigger:
+                    continue
+                self.first_chars.add(trigger[0])
+                if match == 'prefix':
+                    prefix_tables.setdefault(len(trigger), {}).setdefault(trigger, response)
+                else:
+                    self.exact.setdefault(trigger, response)
+        # Longest prefix wins
+        self.prefixes = sorted(prefix_tables.items(), reverse=True)
+
+    def match(self, content: str) -> Optional[str]:
+        """Return the response for the first matching command, if any"""
+        if not content:
+            return None
+        if content[0].lower() in self.first_chars:
+            lowered = content.lower()
+            response = self.exact.get(lowered)
+            if response:
+                return response
+            for length, table in self.prefixes:
+                response = table.get(lowered[:length])
+                if response:
+                    return response
+        for pattern, response in self.patterns:
+            if pattern.search(content):
+                return response
+        return None
+
+
+# Context assembly
+class TokenCounter:
+    """Count tokens with tiktoken when it is installed, otherwise estimate
+
+    The encoding is loaded by load(), which the bot runs on a worker thread
+    after connecting; counts are estimated until it is ready.
+    """
+
+    # Rough per-message overhead of the chat format (role, separators)
+    MESSAGE_OVERHEAD = 4
+
+    def __init__(self, tokenizer: str = "auto", encoding_name: str = "cl100k_base"):
+        self.tokenizer = tokenizer
+        self.encoding_name = encoding_name
+        self._encoding = None
+
+    def load(self) -> None:
+        if self.tokenizer not in ("auto", "tiktoken"):
+            return
+        try:
+            import tiktoken
+            self._encoding = tiktoken.get_encoding(self.encoding_name)
+        except Exception as e:
+            if self.tokenizer == "tiktoken":
+                logger.warning(f"tiktoken unavailable ({e}), estimating token counts instead")
+
+    def count(self, text: str) -> int:
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        # About four characters per token for English prose
+        return (len(text) + 3) // 4
+
+    def count_message(self, message: Dict) -> int:
+        return self.count(message.get('content', '')) + self.MESSAGE_OVERHEAD
+
+
+# Provider client
+class ProviderError(Exception):
+    """A completion request that failed after all retries"""
+
+
+class _RetryableError(Exception):
+    """A transient failure, optionally with a server-requested delay"""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Per-model circuit breaker
+
+    After failure_threshold consecutive failures the breaker opens and the
+    model is skipped. Once reset_timeout has passed it goes half-open and
+    lets traffic through again: one success closes it, one failure reopens it.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        metrics.set_gauge('circuit_breaker_state', 0, model=name)
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self._transition(self.HALF_OPEN)
+        return self.state != self.OPEN
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self._transition(self.CLOSED)
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        metrics.incr('provider_failures_total', model=self.name)
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._transition(self.OPEN)
+
+    def _transition(self, state: str) -> None:
+        if state == self.state:
+            return
+        logger.warning(f"Circuit breaker for {self.name}: {self.state} -> {state} ({self.failures} failures)")
+        self.state = state
+        metrics.incr('circuit_breaker_transitions_total', model=self.name, state=state)
+        metrics.set_gauge('circuit_breaker_state', self.STATE_VALUES[state], model=self.name)
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    """Seconds to wait according to Retry-After or x-ratelimit-reset headers"""
+    value = headers.get('Retry-After')
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    # OpenAI-style durations such as "1s", "250ms" or "6m0s"
+    value = headers.get('x-ratelimit-reset-requests') or headers.get('x-ratelimit-reset-tokens')
+    if value:
+        total = 0.0
+        for amount, unit in re.findall(r'([\d.]+)(ms|s|m|h)', value):
+            total += float(amount) * {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}[unit]
+        return total or None
+    return None
+
+
+class Upstream:
+    """One OpenAI-compatible endpoint with its own keep-alive connection pool
+
+    The endpoint URL and auth headers are built once here rather than on
+    every request; configure() rebuilds them after a character edit.
+    """
+
+    def __init__(self, name: str, config: Dict):
+        self.name = name
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._owns_session = True
+        self.configure(config)
+
+    def configure(self, config: Dict) -> None:
+        self.config = config
+        if self.name == 'default':
+            api_url = config.get('api_url', os.getenv('API_URL', 'https://api.electronhub.top'))
+            api_key = config.get('api_key', os.getenv('API_KEY'))
+        else:
+            # API_KEY belongs to the default provider; never send it to another host
+            api_url = config['api_url']
+            api_key = config.get('api_key')
+        
+        # Support legacy ElectronHub config
+        if not api_key and 'electron_hub_proxy_key' in config:
+            api_key = config['electron_hub_proxy_key']
+        
+        # Ensure proper URL format
+        if not api_url.endswith('/v1/chat/completions'):
+            api_url = api_url.rstrip('/') + '/v1/chat/completions'
+        
+        self.url = api_url
+        self.headers = {"Content-Type": "application/json"}
+        if api_key:
+            self.headers["Authorization"] = f"Bearer {api_key}"
+        self.models = set(config.get('models', []))
+
+    def open(self, defaults: Dict, shared_session: Optional[aiohttp.ClientSession] = None) -> None:
+        """Create the pooled session (must run inside the event loop)"""
+        if shared_session is not None:
+            self.session = shared_session
+            self._owns_session = False
+            return
+        settings = dict(defaults)
+        settings.update(self.config)
+        self.session = create_pooled_session(self.name, settings)
+        self._owns_session = True
+
+    async def close(self) -> None:
+        if self.session and self._owns_session:
+            await self.session.close()
+        self.session = None
+
+
+def create_pooled_session(name: str, settings: Dict) -> aiohttp.ClientSession:
+    """Create a keep-alive session with a sized pool and DNS cache
+
+    New and reused connections are counted per pool so the reuse ratio
+    can be reported as provider_connection_reuse_ratio.
+    """
+    pool_size = int(settings.get('pool_size', 20))
+    connector = aiohttp.TCPConnector(
+        limit=pool_size,
+        limit_per_host=pool_size,
+        ttl_dns_cache=int(settings.get('dns_cache_ttl', 300)),
+        keepalive_timeout=float(settings.get('keepalive_timeout', 60))
+    )
+
+    def update_reuse_ratio() -> None:
+        new = metrics.counters[Metrics._key('provider_connections_total', {'upstream': name, 'kind': 'new'})]
+        reused = metrics.counters[Metrics._key('provider_connections_total', {'upstream': name, 'kind': 'reused'})]
+        metrics.set_gauge('provider_connection_reuse_ratio', reused / (new + reused), upstream=name)
+
+    async def on_new_connection(session, ctx, params) -> None:
+        metrics.incr('provider_connections_total', upstream=name, kind='new')
+        update_reuse_ratio()
+
+    async def on_reused_connection(session, ctx, params) -> None:
+        metrics.incr('provider_connections_total', upstream=name, kind='reused')
+        update_reuse_ratio()
+
+    trace = aiohttp.TraceConfig()
+    trace.on_connection_create_end.append(on_new_connection)
+    trace.on_connection_reuseconn.append(on_reused_connection)
+    return aiohttp.ClientSession(connector=connector, trace_configs=[trace])
+
+
+class Route:
+    """One model on one upstream, with rolling latency and error stats
+
+    Both are exponentially weighted moving averages, so a route that
+    slows down or starts failing loses traffic within a few requests.
+    """
+
+    def __init__(self, name: str, upstream: str, model: str, weight: float = 1.0,
+                 fallback: bool = False, alpha: float = 0.2):
+        self.name = name
+        self.upstream = upstream
+        self.model = model
+        self.weight = weight
+        self.fallback = fallback
+        self.alpha = alpha
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+
+    def record(self, seconds: Optional[float]) -> None:
+        """Record a finished request: its latency, or None if it failed"""
+        failed = seconds is None
+        self.error_rate += self.alpha * (failed - self.error_rate)
+        if not failed:
+            self.latency = seconds if self.latency is None else self.latency + self.alpha * (seconds - self.latency)
+            metrics.set_gauge('router_route_latency_seconds', self.latency, route=self.name)
+        metrics.set_gauge('router_route_error_rate', self.error_rate, route=self.name)
+
+    @property
+    def cost(self) -> float:
+        """Expected seconds to get an answer, counting retries after failures, per unit of weight"""
+        if self.latency is None:
+            # Untried routes go first, routes that have only ever failed last
+            return math.inf if self.error_rate else 0.0
+        return self.latency / max(0.05, 1 - self.error_rate) / self.weight
+
+
+class ProviderClient:
+    """Chat completion client with timeouts, jittered retries and circuit breakers
+
+    The top-level language_model settings form the "default" upstream;
+    entries under language_model.upstreams add more endpoints (a local
+    Ollama next to a hosted API, for example), each serving the models
+    listed in its "models" field. Settings are read from the config on
+    every call, so edits made with !character and !model apply straight away.
+
+    Without language_model.routes, the selected model is tried and then the
+    fallback. With routes, every request goes to the healthy route with the
+    lowest expected latency (see Route.cost), and a slow request can be
+    hedged on the next route after hedge_after seconds.
+    """
+
+    RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+    def __init__(self, config: Dict, shared_session: Optional[aiohttp.ClientSession] = None):
+        self.config = config
+        self.shared_session = shared_session
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.upstreams: Dict[str, Upstream] = {}
+        self.routes: Dict[str, Route] = {}
+        self.routed: List[Route] = []
+        self.reload()
+
+    def reload(self) -> None:
+        """Rebuild endpoint URLs and headers from the current config"""
+        configs = {'default': self.config}
+        configs.update(self.config.get('upstreams', {}))
+        for name, config in configs.items():
+            if name != 'default' and not config.get('api_url'):
+                logger.warning(f"Skipping upstream '{name}': it needs its own api_url")
+                continue
+            if name in self.upstreams:
+                self.upstreams[name].configure(config)
+            else:
+                upstream = Upstream(name, config)
+                self.upstreams[name] = upstream
+                if self.upstreams['default'].session is not None:
+                    # Added while running
+                    upstream.open(self.config, self.shared_session)
+
+        self.routed = []
+        for entry in self.config.get('routes', []):
+            upstream = entry.get('upstream', 'default')
+            if upstream not in self.upstreams or not entry.get('model'):
+                logger.warning(f"Skipping route {entry}: needs a model and a known upstream")
+                continue
+            name = entry.get('name') or f"{upstream}:{entry['model']}"
+            route = self.routes.get(name)
+            if route is None:
+                route = self.routes[name] = Route(name, upstream, entry['model'])
+            # Stats survive an edit; the settings are taken fresh
+            route.upstream, route.model = upstream, entry['model']
+            route.weight = max(0.01, float(entry.get('weight', 1.0)))
+            route.fallback = bool(entry.get('fallback', False))
+            self.routed.append(route)
+
+    async def start(self) -> None:
+        for upstream in self.upstreams.values():
+            if upstream.session is None:
+                upstream.open(self.config, self.shared_session)
+
+    async def close(self) -> None:
+        for upstream in self.upstreams.values():
+            await upstream.close()
+
+    def upstream_for(self, model: str) -> Upstream:
+        for upstream in self.upstreams.values():
+            if model in upstream.models:
+                return upstream
+        return self.upstreams['default']
+
+    def route(self, model: str) -> Route:
+        """The implicit route for a model named in selected_model or fallback_model"""
+        route = self.routes.get(model)
+        if route is None:
+            route = self.routes[model] = Route(model, 'default', model)
+        # Upstream model lists can change with a character edit
+        route.upstream = self.upstream_for(model).name
+        return route
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        if model not in self.breakers:
+            self.breakers[model] = CircuitBreaker(
+                model,
+                failure_threshold=int(self.config.get('breaker_threshold', 5)),
+                reset_timeout=float(self.config.get('breaker_reset', 30.0))
+            )
+        return self.breakers[model]
+
+    def candidate_routes(self, use_fallback: bool = False) -> List[Route]:
+        """Routes to try in order, skipping any whose breaker is open"""
+        if self.routed:
+            preferred, reason = self._rank([route for route in self.routed if route.fallback == use_fallback])
+            others, _ = self._rank([route for route in self.routed if route.fallback != use_fallback])
+            routes = preferred + others
+            if routes:
+                metrics.incr('router_decisions_total', route=routes[0].name,
+                             reason=reason if preferred else 'failover')
+        else:
+            primary = self.config.get('selected_model', 'gpt-3.5-turbo')
+            fallback = self.config.get('fallback_model')
+            if use_fallback:
+                models = [fallback or 'gpt-3.5-turbo']
+            else:
+                models = [primary] + ([fallback] if fallback and fallback != primary else [])
+            routes = [self.route(model) for model in models]
+        available = [route for route in routes if self.breaker(route.name).allow()]
+        if not available:
+            logger.warning(f"All models unavailable (circuit open): {', '.join(route.name for route in routes)}")
+        return available
+
+    def _rank(self, routes: List[Route]) -> Tuple[List[Route], str]:
+        """Cheapest healthy route first; now and then a weighted random one, to keep stats fresh
+
+        Also returns why the first route was picked, for the router_decisions_total metric.
+        """
+        routes = [route for route in routes if self.breaker(route.name).allow()]
+        if not routes:
+            return [], 'none'
+        ranked = sorted(routes, key=lambda route: route.cost)
+        reason = 'untried' if ranked[0].latency is None else 'fastest'
+        if len(ranked) > 1 and random.random() < float(self.config.get('explore', 0.05)):
+            pick = random.choices(ranked, weights=[route.weight for route in ranked])[0]
+            ranked.remove(pick)
+            ranked.insert(0, pick)
+            reason = 'explore'
+        return ranked, reason
+
+    def build_request(self, messages, route: Route, stream: bool = False):
+        """Pick the upstream for a route and build the request payload"""
+        data = {
+            "model": route.model,
+            "messages": messages,
+            "temperature": 0.8,
+            "max_tokens": 1000,
+            "top_p": 0.9,
+            "frequency_penalty": 0.1,
+            "presence_penalty": 0.1
+        }
+        if stream:
+            data["stream"] = True
+        
+        return self.upstreams.get(route.upstream) or self.upstream_for(route.model), data
+
+    def _backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        if retry_after is not None:
+            return retry_after
+        # Full jitter: uniform between zero and the exponential ceiling
+        ceiling = min(float(self.config.get('backoff_max', 8.0)),
+                      float(self.config.get('backoff_base', 0.5)) * (2 ** attempt))
+        return random.uniform(0, ceiling)
+
+    async def _with_retries(self, route: Route, attempt_once):
+        """Run attempt_once with retries, feeding the outcome to the route's breaker and stats"""
+        model = route.name
+        breaker = self.breaker(model)
+        max_retries = int(self.config.get('max_retries', 2))
+        backoff_max = float(self.config.get('backoff_max', 8.0))
+        
+        for attempt in range(max_retries + 1):
+            try:
+                result = await attempt_once()
+                breaker.record_success()
+                return result
+            except _RetryableError as e:
+                breaker.record_failure()
+                route.record(None)
+                delay = self._backoff(attempt, e.retry_after)
+                if attempt == max_retries or delay > backoff_max or not breaker.allow():
+                    # Waiting longer than that is worse than trying the fallback
+                    raise ProviderError(str(e)) from None
+                metrics.incr('provider_retries_total', model=model)
+                logger.info(f"Retrying {model} in {delay:.1f}s ({e})")
+                await asyncio.sleep(delay)
+
+    async def _check_status(self, response) -> None:
+        if response.status == 200:
+            return
+        error_text = (await response.text())[:500]
+        if response.status in self.RETRYABLE_STATUSES:
+            raise _RetryableError(f"HTTP {response.status}", parse_retry_after(response.headers))
+        # Other client errors won't succeed on retry and don't mean the model is down
+        raise ProviderError(f"HTTP {response.status} - {error_text}")
+
+    async def complete(self, messages, route: Route) -> str:
+        """Return the completion text, raising ProviderError on failure"""
+        upstream, data = self.build_request(messages, route)
+        model = route.name
+        timeout = aiohttp.ClientTimeout(total=float(self.config.get('request_timeout', 60)))
+
+        async def attempt_once():
+            started = time.perf_counter()
+            try:
+                async with upstream.session.post(upstream.url, headers=upstream.headers, json=data,
+                                                 timeout=timeout) as response:
+                    metrics.observe('upstream_ttfb_seconds', time.perf_counter() - started, model=model)
+                    await self._check_status(response)
+                    result = await response.json()
+                    try:
+                        content = result['choices'][0]['message']['content'].strip()
+                    except (KeyError, IndexError, TypeError, AttributeError):
+                        # A 200 without a completion (a proxy page, an error object):
+                        # count it against the route so the fallback gets a turn
+                        raise _RetryableError(f"Unexpected response body: {str(result)[:200]}")
+                    elapsed = time.perf_counter() - started
+                    metrics.observe('upstream_seconds', elapsed, model=model)
+                    route.record(elapsed)
+                    return content
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                # ValueError: the body wasn't valid JSON
+                raise _RetryableError(f"{type(e).__name__}: {e}")
+
+        return await self._with_retries(route, attempt_once)
+
+    async def complete_routed(self, messages, use_fallback: bool = False) -> Tuple[Optional[str], Optional[Route]]:
+        """Complete on the best route, failing over down the ranking
+
+        With hedge_after set, a request still running after that many
+        seconds is raced against the next route. The first answer wins and
+        the other request is cancelled. Returns (None, None) if every
+        route failed.
+        """
+        routes = self.candidate_routes(use_fallback)
+        hedge_after = float(self.config.get('hedge_after', 0)) or None
+        pending: Dict[asyncio.Task, Route] = {}
+        started: Dict[asyncio.Task, float] = {}
+        hedges = set()
+        next_route = 0
+
+        def launch(hedge: bool = False) -> None:
+            nonlocal next_route
+            route = routes[next_route]
+            next_route += 1
+            task = asyncio.create_task(self.complete(messages, route))
+            pending[task] = route
+            started[task] = time.perf_counter()
+            if hedge:
+                hedges.add(task)
+
+        try:
+            while pending or next_route < len(routes):
+                if not pending:
+                    launch()
+                # Hedge at most one request at a time
+                can_hedge = hedge_after and len(pending) == 1 and next_route < len(routes)
+                done, _ = await asyncio.wait(pending, timeout=hedge_after if can_hedge else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    metrics.incr('router_hedges_total', route=routes[next_route].name)
+                    logger.info(f"Hedging {', '.join(r.name for r in pending.values())} "
+                                f"with {routes[next_route].name} after {hedge_after}s")
+                    launch(hedge=True)
+                    continue
+                for task in done:
+                    route = pending.pop(task)
+                    try:
+                        response = task.result()
+                    except ProviderError as e:
+                        logger.warning(f"Model {route.name} failed: {e}")
+                        continue
+                    for loser, loser_route in pending.items():
+                        # It would have taken at least this long; without a sample
+                        # a route that always loses would look untried forever
+                        loser_route.record(time.perf_counter() - started[loser])
+                    if task in hedges:
+                        # The hedge answered first, so hedging saved time on this request
+                        metrics.incr('router_hedge_wins_total', route=route.name)
+                    return response, route
+            return None, None
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def stream(self, messages, route: Route):
+        """Yield completion text deltas, raising ProviderError on failure
+
+        Only the connection is retried; once tokens have been yielded a
+        failure is raised straight away.
+        """
+        upstream, data = self.build_request(messages, route, stream=True)
+        model = route.name
+        # No total limit for streams, but a stalled connection still times out
+        read_timeout = float(self.config.get('request_timeout', 60))
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=read_timeout)
+
+        started = time.perf_counter()
+
+        async def open_stream():
+            try:
+                response = await upstream.session.post(upstream.url, headers=upstream.headers, json=data,
+                                                       timeout=timeout)
+                ttfb = time.perf_counter() - started
+                metrics.observe('upstream_ttfb_seconds', ttfb, model=model)
+                # A stream's length depends on the reply, so routes are compared on time to first byte
+                if response.status == 200:
+                    route.record(ttfb)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise _RetryableError(f"{type(e).__name__}: {e}")
+            try:
+                await self._check_status(response)
+            except Exception:
+                response.release()
+                raise
+            return response
+
+        response = await self._with_retries(route, open_stream)
+        try:
+            # Server-sent events: one "data: {...}" line per chunk
+            async for raw_line in response.content:
+                line = raw_line.decode('utf-8', errors='replace').strip()
+                if not line.startswith('data:'):
+                    continue
+                payload = line[5:].strip()
+                if payload == '[DONE]':
+                    break
+                try:
+                    chunk = json.loads(payload)
+                    delta = chunk['choices'][0].get('delta', {}).get('content')
+                except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+                    continue
+                if delta:
+                    yield delta
+            metrics.observe('upstream_seconds', time.perf_counter() - started, model=model)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.breaker(model).record_failure()
+            route.record(None)
+            raise ProviderError(f"Stream interrupted: {type(e).__name__}: {e}") from None
+        finally:
+            response.release()
+
+
+# Response cache
+class ResponseCache(BackgroundLoad):
+    """TTL + LRU cache of replies to repeated prompts
+
+    Keys combine the normalized user message with a digest of the system
+    prompt (which covers character revision and mode), so any character
+    edit or mode switch naturally misses. A reply written from a user's
+    own history or recall is keyed to that user as well, so it is never
+    served to anyone else. Size is bounded by the total characters stored
+    rather than entry count.
+    """
+
+    def __init__(self, path: Optional[str] = None, ttl: float = 3600, max_chars: int = 1_000_000):
+        self.path = path
+        self.ttl = ttl
+        self.max_chars = max_chars
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._chars = 0
+
+    @staticmethod
+    def normalize(content: str) -> str:
+        """Lowercase and strip punctuation and extra whitespace"""
+        return ' '.join(re.sub(r'[^\w\s]', ' ', content.lower()).split())
+
+    @staticmethod
+    def make_key(content: str, system_prompt: str, user_id: Optional[int] = None) -> str:
+        """Key for a reply; user_id scopes it to one user when the prompt was personal"""
+        digest = hashlib.blake2b(system_prompt.encode('utf-8'), digest_size=8).hexdigest()
+        scope = f"u{user_id}" if user_id is not None else "all"
+        return f"{digest}:{scope}:{ResponseCache.normalize(content)}"
+
+    @property
+    def size_chars(self) -> int:
+        return self._chars
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            metrics.incr('response_cache_total', result='miss')
+            return None
+        expires_at, response = entry
+        if expires_at < time.time():
+            self._remove(key)
+            metrics.incr('response_cache_total', result='expired')
+            return None
+        self._entries.move_to_end(key)
+        metrics.incr('response_cache_total', result='hit')
+        return response
+
+    def put(self, key: str, response: str, expires_at: Optional[float] = None) -> None:
+        if key in self._entries:
+            self._remove(key)
+        size = len(key) + len(response)
+        if size > self.max_chars:
+            return
+        self._entries[key] = (expires_at or time.time() + self.ttl, response)
+        self._chars += size
+        while self._chars > self.max_chars:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            metrics.incr('response_cache_evictions_total')
+        metrics.set_gauge('response_cache_chars', self._chars)
+
+    def _remove(self, key: str) -> None:
+        _, response = self._entries.pop(key)
+        self._chars -= len(key) + len(response)
+
+    def load(self) -> None:
+        """Load unexpired entries saved by a previous run"""
+        if not self.path:
+            return
+        try:
+            data = read_json_file(self.path)
+        except (FileNotFoundError, ValueError):
+            return
+        now = time.time()
+        for key, expires_at, response in data:
+            if expires_at > now:
+                self.put(key, response, expires_at)
+
+    def _read(self) -> None:
+        self.load()
+
+    def _loaded_summary(self) -> str:
+        return f"{len(self._entries)} cached responses"
+
+    def save(self) -> None:
+        if not self.path or not self._loaded:
+            # Never overwrite the saved cache with a partly loaded one
+            return
+        now = time.time()
+        data = [[key, expires_at, response] for key, (expires_at, response) in self._entries.items()
+                if expires_at > now]
+        write_file_atomic(self.path, json_dumps(data))
+
+
+# Feedback
+class ReplyRecord:
+    """What produced one reply, so feedback and regeneration can refer back to it
+
+    origin (the user's discord.Message) and prompt (the messages sent to
+    the model) are only held in memory and are not persisted.
+    """
+
+    __slots__ = ('message_ids', 'origin_id', 'channel_id', 'user_id', 'content', 'response', 'model',
+                 'mode', 'revision', 'prompt_tokens', 'completion_tokens', 'created', 'origin', 'prompt')
+
+    FIELDS = __slots__[:-2]
+
+    def __init__(self, message_ids: List[int], origin_id: int, channel_id: int, user_id: int, content: str,
+                 response: str, model: Optional[str], mode: str, revision: int = 0, prompt_tokens: int = 0,
+                 completion_tokens: int = 0, created: Optional[float] = None, origin=None,
+                 prompt: Optional[List[Dict]] = None):
+        self.message_ids = message_ids
+        self.origin_id = origin_id
+        self.channel_id = channel_id
+        self.user_id = user_id
+        self.content = content
+        self.response = response
+        self.model = model
+        self.mode = mode
+        self.revision = revision
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.created = created or time.time()
+        self.origin = origin
+        self.prompt = prompt
+
+    def to_dict(self) -> Dict:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+class FeedbackStore(BackgroundLoad):
+    """Index of recent replies by message ID, plus a log of every reply and rating
+
+    The newest max_entries replies are indexed in memory so 🔄 can find
+    the prompt behind a reply without scanning channel history. Replies
+    and ratings are appended to feedback_<name>.log as JSON lines for
+    offline analysis (see --feedback-report). The log is rotated to
+    feedback_<name>.log.1 once it reaches max_bytes. On startup the index
+    is rebuilt by reading the log backwards until max_entries replies are
+    found, so startup doesn't slow down as the log grows.
+    """
+
+    RATINGS = {'🔄': 'regenerate', '❤️': 'good', '💔': 'bad'}
+
+    def __init__(self, path: Optional[str], max_entries: int = 500, flush_interval: float = 2.0,
+                 max_bytes: int = 16 * 1024 * 1024):
+        self.path = path
+        self.max_entries = max_entries
+        self._replies: "OrderedDict[int, ReplyRecord]" = OrderedDict()
+        self._log = RecordLog(path, flush_interval, max_bytes=max_bytes) if path else None
+
+    def _index(self, record: ReplyRecord) -> None:
+        for message_id in record.message_ids:
+            self._replies[message_id] = record
+            self._replies.move_to_end(message_id)
+        while len(self._replies) > self.max_entries:
+            self._replies.popitem(last=False)
+
+    def _read_tail(self) -> List[ReplyRecord]:
+        """The newest max_entries replies, oldest first"""
+        self._log.recover()
+        records: List[ReplyRecord] = []
+        for path in (self.path, self.path + '.1'):
+            if not os.path.exists(path):
+                continue
+            for line in iter_lines_backward(path):
+                if len(records) >= self.max_entries:
+                    break
+                try:
+                    entry = json_loads(line)
+                    if entry.pop('type', None) == 'reply':
+                        entry.pop('t', None)
+                        records.append(ReplyRecord(**entry))
+                except (ValueError, TypeError, AttributeError):
+                    continue
+        records.reverse()
+        return records
+
+    def _enqueue(self, entry: Dict) -> None:
+        if self._log:
+            entry['t'] = round(time.time(), 3)
+            self._log.append(entry)
+
+    def find(self, message_id: int) -> Optional[ReplyRecord]:
+        return self._replies.get(message_id)
+
+    def forget(self, record: ReplyRecord) -> None:
+        """Drop a reply from the index, e.g. once it is being regenerated"""
+        for message_id in record.message_ids:
+            self._replies.pop(message_id, None)
 
-# Setup logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
+    def record_reply(self, record: ReplyRecord) -> None:
+        self._index(record)
+        self._enqueue({'type': 'reply', **record.to_dict()})
 
-# Memory interface
-from abc import ABC, abstractmethod
+    def record_feedback(self, message_id: int, user_id: int, emoji: str) -> None:
+        """Log a rating given on a reply, with the model and mode that produced it"""
+        rating = self.RATINGS.get(emoji)
+        if rating is None:
+            return
+        record = self.find(message_id)
+        model = record.model if record else None
+        mode = record.mode if record else None
+        metrics.incr('feedback_total', rating=rating, model=model or 'unknown', mode=mode or 'unknown')
+        self._enqueue({'type': 'feedback', 'message_id': message_id, 'user_id': user_id,
+                       'rating': rating, 'model': model, 'mode': mode})
 
-class MemoryInterface(ABC):
-    """Abstract base class for memory systems"""
-    
-    @abstractmethod
-    async def get_memories(self, user_id: int, limit: int = 20) -> List[Dict]:
-        pass
-    
-    @abstractmethod
-    async def add_memory(self, user_id: int, role: str, content: str) -> None:
-        pass
-    
-    @abstractmethod
-    async def clear_memories(self, user_id: int) -> None:
-        pass
+    async def flush(self) -> None:
+        if self._log:
+            await self._log.flush()
 
+    def _read(self) -> List[ReplyRecord]:
+        return self._read_tail() if self._log else []
 
-class LocalMemory(MemoryInterface):
-    """Local JSON file storage for fps.ms compatibility"""
-    
-    def __init__(self, character_name: str = "bot"):
-        self.character_name = character_name.lower().replace(" ", "_")
-        self.memory_file = f"memories_{self.character_name}.json"
-        self.memories: Dict[int, List] = self._load_memories()
-    
-    def _load_memories(self) -> Dict[int, List]:
-        """Load memories from JSON file"""
+    def _finish_load(self, records: List[ReplyRecord]) -> None:
+        # Replies recorded while the log was being read are newer; keep them last
+        recent = list(self._replies.values())
+        self._replies.clear()
+        for record in records + recent:
+            self._index(record)
+
+    def _loaded_summary(self) -> str:
+        return f"{len(self._replies)} indexed replies"
+
+    async def start(self) -> None:
+        """Start rebuilding the index; callers await ensure_loaded() before find()"""
+        self.start_loading()
+        if self._log:
+            self._log.start()
+
+    async def close(self) -> None:
+        if self._load_task:
+            await self._load_task
+        if self._log:
+            await self._log.close()
+
+
+def feedback_report(path: str) -> Dict[str, Dict[str, int]]:
+    """Count replies and ratings per model and mode in a feedback log and its rotated file"""
+    report: Dict[str, Dict[str, int]] = {}
+    for log_path in (path + '.1', path):
+        if not os.path.exists(log_path):
+            continue
+        with open(log_path, 'rb') as f:
+            for line in f:
+                try:
+                    entry = json_loads(line)
+                except ValueError:
+                    continue
+                row = report.setdefault(f"{entry.get('model')} ({entry.get('mode')})",
+                                        {'replies': 0, 'good': 0, 'bad': 0, 'regenerate': 0})
+                if entry.get('type') == 'reply':
+                    row['replies'] += 1
+                elif entry.get('rating') in row:
+                    row[entry['rating']] += 1
+    return report
+
+
+# Request scheduling
+class GenerationJob:
+    """A pending reply for one user"""
+
+    def __init__(self, message, content: str, options: Dict):
+        self.message = message
+        self.content = content
+        self.options = options
+        self.user_id = message.author.id
+        self.channel_id = message.channel.id
+        self.enqueued_at = time.monotonic()
+        # Messages that were shown a busy indicator while waiting
+        self.marked: List = []
+
+
+class GenerationScheduler:
+    """Bounded, channel-fair queue in front of the LLM calls
+
+    At most max_concurrent generations run at once, and at most one per
+    user. Messages from a user who already has a reply queued in the same
+    channel are merged into that reply; messages from another channel and
+    jobs with options (regenerations) are never merged and wait their turn
+    behind it. Channels with waiting users are served
+    round-robin, so one busy channel can't starve the rest.
+    """
+
+    def __init__(self, handler, max_concurrent: int = 4, on_queued=None, on_started=None):
+        self.handler = handler
+        self.max_concurrent = max_concurrent
+        self.on_queued = on_queued
+        self.on_started = on_started
+        self._pending: Dict[int, deque] = {}
+        self._channels: "OrderedDict[int, deque]" = OrderedDict()
+        self._active_users = set()
+        self._tasks = set()
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(jobs) for jobs in self._pending.values())
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._active_users)
+
+    def submit(self, message, content: str, **options) -> None:
+        """Queue a reply, merging it with the user's queued reply in that channel if there is one
+
+        Keyword options are passed through to the handler. A job with
+        options is queued on its own, since they describe that one reply.
+        """
+        user_id = message.author.id
+        jobs = self._pending.get(user_id)
+        job = jobs[-1] if jobs else None
+        if job and job.channel_id == message.channel.id and not job.options and not options:
+            job.content = f"{job.content}\n{content}"
+            job.message = message
+            metrics.incr('scheduler_coalesced_total')
+        else:
+            job = GenerationJob(message, content, options)
+            if jobs:
+                jobs.append(job)
+            else:
+                self._pending[user_id] = deque([job])
+                if user_id not in self._active_users:
+                    self._channels.setdefault(job.channel_id, deque()).append(user_id)
+        metrics.incr('scheduler_submitted_total')
+
+        self._dispatch()
+        if job in self._pending.get(user_id, ()) and self.on_queued:
+            job.marked.append(message)
+            self._spawn(self.on_queued(message))
+        self._update_gauges()
+
+    def _dispatch(self) -> None:
+        while len(self._active_users) < self.max_concurrent and self._channels:
+            channel_id, users = next(iter(self._channels.items()))
+            user_id = users.popleft()
+            del self._channels[channel_id]
+            if users:
+                # Back of the line for this channel
+                self._channels[channel_id] = users
+            jobs = self._pending[user_id]
+            job = jobs.popleft()
+            if not jobs:
+                del self._pending[user_id]
+            self._active_users.add(user_id)
+            self._spawn(self._run(job))
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job: GenerationJob) -> None:
+        metrics.observe('scheduler_wait_seconds', time.monotonic() - job.enqueued_at)
         try:
-            with open(self.memory_file, 'r') as f:
-                data = json.load(f)
-                return {int(k): v for k, v in data.items()}
-        except (FileNotFoundError, json.JSONDecodeError):
-            return {}
-    
-    def _save_memories(self) -> None:
-        """Save memories to JSON file"""
-        data = {str(k): v for k, v in self.memories.items()}
-        with open(self.memory_file, 'w') as f:
-            json.dump(data, f, indent=2)
-    
-    async def get_memories(self, user_id: int, limit: int = 20) -> List[Dict]:
-        if user_id not in self.memories:
-            return []
-        return self.memories[user_id][-limit:]
-    
-    async def add_memory(self, user_id: int, role: str, content: str) -> None:
-        if user_id not in self.memories:
-            self.memories[user_id] = []
-        
-        self.memories[user_id].append({"role": role, "content": content})
-        
-        if len(self.memories[user_id]) > 50:
-            self.memories[user_id] = self.memories[user_id][-50:]
-        
-        self._save_memories()
-    
-    async def clear_memories(self, user_id: int) -> None:
-        if user_id in self.memories:
-            self.memories[user_id] = []
-            self._save_memories()
+            if self.on_started:
+                # Clearing the busy markers is cosmetic; don't make the reply wait on it
+                for message in job.marked:
+                    self._spawn(self.on_started(message))
+            await self.handler(job.message, job.content, **job.options)
+        except Exception as e:
+            logger.error(f"Scheduled generation failed: {e}")
+        finally:
+            self._active_users.discard(job.user_id)
+            jobs = self._pending.get(job.user_id)
+            if jobs:
+                # Messages that arrived meanwhile are waiting in the user's next job
+                self._channels.setdefault(jobs[0].channel_id, deque()).append(job.user_id)
+            self._dispatch()
+            self._update_gauges()
+
+    def _update_gauges(self) -> None:
+        metrics.set_gauge('scheduler_queue_depth', self.queue_depth)
+        metrics.set_gauge('scheduler_in_flight', self.in_flight)
+
+
+# Gateway
+def build_intents(gateway_config: Dict) -> discord.Intents:
+    """Only the gateway intents the bot's features use
+
+    Members and presences are not needed (author names come with each
+    message) and presence updates are by far the noisiest event stream.
+    gateway.extra_intents can switch others back on for custom features.
+    """
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.guild_messages = True
+    intents.dm_messages = True
+    intents.message_content = True
+    intents.guild_reactions = True
+    intents.dm_reactions = True
+    for name in gateway_config.get('extra_intents', []):
+        if name not in discord.Intents.VALID_FLAGS:
+            logger.warning(f"Unknown intent '{name}' in gateway.extra_intents")
+            continue
+        setattr(intents, name, True)
+    return intents
+
+
+def read_character_file(path: str) -> Dict:
+    """Load character data from JSON file"""
+    try:
+        return read_json_file(path)
+    except FileNotFoundError:
+        logger.error(f"Character file {path} not found. Using template.")
+        return read_json_file('character_template.json')
+
+
+class CharacterError(ValueError):
+    """Character data that the bot can't run with"""
+
+
+class CharacterSettings:
+    """The character settings read on the reply path, validated once
+
+    Built from the character data at startup and after every edit, so
+    each reply reads attributes instead of walking nested dicts.
+    """
+
+    __slots__ = ('name', 'slug', 'stream', 'stream_edit_interval', 'feedback', 'context_budget',
+                 'long_term', 'long_term_recall', 'summary_batch', 'response_cache', 'response_cache_persist',
+                 'log_feedback', 'sharded')
+
+    SECTIONS = ('profile', 'personality', 'knowledge', 'language_model', 'memory_system', 'output', 'gateway')
+    FEEDBACK_MODES = ('reactions', 'buttons', 'none')
+
+    def __init__(self, character_data: Dict):
+        if not isinstance(character_data, dict):
+            raise CharacterError("character data must be a JSON object")
+        for section in self.SECTIONS:
+            if not isinstance(character_data.get(section, {}), dict):
+                raise CharacterError(f"'{section}' must be an object")
+        name = character_data.get('profile', {}).get('name')
+        if not isinstance(name, str) or not name.strip():
+            raise CharacterError("profile.name is required")
+        self.name = name
+        self.slug = name.lower().replace(" ", "_")
+
+        model_config = character_data.get('language_model', {})
+        self.stream = self._flag('stream', model_config.get('stream', False), False)
+        self.stream_edit_interval = self._number('stream_edit_interval', model_config.get('stream_edit_interval', 1.5), 1.5, float)
+        budget = model_config.get('context_budget', 6000)
+        if isinstance(budget, dict):
+            default = self._number('context_budget.default', budget.get('default', 6000), 6000, int)
+            # The prompt is built before a model is picked, so it has to fit whichever may answer
+            self.context_budget = min(self._number(f'context_budget.{model}', budget.get(model, default), default, int)
+                                      for model in self._answering_models(model_config))
+        else:
+            self.context_budget = self._number('context_budget', budget, 6000, int)
+
+        cache_config = model_config.get('response_cache', {})
+        self.response_cache = self._flag('response_cache.enabled', cache_config.get('enabled'), False)
+        self.response_cache_persist = self._flag('response_cache.persist', cache_config.get('persist'), True)
+
+        output = character_data.get('output', {})
+        feedback = output.get('feedback', 'reactions')
+        if feedback not in self.FEEDBACK_MODES:
+            logger.warning(f"Unknown output.feedback '{feedback}', using reactions")
+            feedback = 'reactions'
+        self.feedback = feedback
+        self.log_feedback = self._flag('output.log_feedback', output.get('log_feedback'), True)
+        self.sharded = self._flag('gateway.sharded', character_data.get('gateway', {}).get('sharded'), False)
+
+        long_term = character_data.get('memory_system', {}).get('long_term', {})
+        # summarize_dropped predates the long-term tier and now turns it on
+        self.long_term = (self._flag('long_term.enabled', long_term.get('enabled'), False) or
+                          self._flag('summarize_dropped', model_config.get('summarize_dropped'), False))
+        self.long_term_recall = self._number('long_term.recall', long_term.get('recall', 3), 3, int)
+        self.summary_batch = self._number('long_term.summary_batch', long_term.get('summary_batch', 8), 8, int)
+
+    @staticmethod
+    def _answering_models(model_config: Dict) -> List[str]:
+        """Every model a reply can come from: the routes if set, else the selected and fallback models"""
+        routes = model_config.get('routes') or []
+        models = [route['model'] for route in routes if isinstance(route, dict) and route.get('model')]
+        if not models:
+            models = [model_config.get('selected_model', 'gpt-3.5-turbo')]
+            if model_config.get('fallback_model'):
+                models.append(model_config['fallback_model'])
+        return models
+
+    @staticmethod
+    def _flag(key: str, value, default: bool) -> bool:
+        # !character stores every value as a string, so "false" has to mean False
+        if value is None:
+            return default
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, int) and value in (0, 1):
+            return bool(value)
+        if isinstance(value, str) and value.strip().lower() in ('true', '1', 'false', '0'):
+            return value.strip().lower() in ('true', '1')
+        logger.warning(f"Invalid {key} {value!r}, using {str(default).lower()}")
+        return default
+
+    @staticmethod
+    def _number(key: str, value, default, cast):
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            logger.warning(f"Invalid {key} {value!r}, using {default}")
+            return default
+
+
+# Discord output
+FEEDBACK_EMOJI = ('🔄', '❤️', '💔')  # Regenerate, good response, bad response
+
+
+class FeedbackButton(discord.ui.DynamicItem[discord.ui.Button], template=r'studio:feedback:(?P<kind>\d)'):
+    """A feedback button sent along with a reply
+
+    Everything the button needs is in its custom_id, so no per-message view
+    is kept and the buttons keep working after a restart.
+    """
+
+    def __init__(self, kind: int):
+        super().__init__(discord.ui.Button(emoji=FEEDBACK_EMOJI[kind], style=discord.ButtonStyle.secondary,
+                                           custom_id=f'studio:feedback:{kind}'))
+        self.kind = kind
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(int(match['kind']))
+
+    async def callback(self, interaction: discord.Interaction):
+        await interaction.response.defer()
+        await interaction.client.handle_feedback(interaction.message, FEEDBACK_EMOJI[self.kind], interaction.user)
+
+
+def feedback_view() -> discord.ui.View:
+    view = discord.ui.View(timeout=None)
+    for kind in range(len(FEEDBACK_EMOJI)):
+        view.add_item(FeedbackButton(kind))
+    return view
 
 
 # Bot class
 class StudioBot(commands.Bot):
-    def __init__(self):
-        intents = discord.Intents.default()
-        intents.message_content = True
-        intents.reactions = True
-        intents.members = True
-        intents.presences = True
+    def __init__(self, character_file: Optional[str] = None,
+                 shared_session: Optional[aiohttp.ClientSession] = None,
+                 shared_store: Optional[SqliteStore] = None,
+                 character_data: Optional[Dict] = None, worker: Optional[int] = None, **options):
+        self._constructed = time.perf_counter()
+        self.character_file = character_file or os.getenv('CHARACTER_FILE', 'character.json')
+        # Index of the shard worker process running this bot, if any
+        self.worker = worker
+        self.character_data = character_data if character_data is not None else self.load_character_data()
+        self.settings = CharacterSettings(self.character_data)
         
         super().__init__(
             command_prefix='!',
-            intents=intents,
-            help_command=None
+            intents=build_intents(self.character_data.get('gateway', {})),
+            help_command=None,
+            **options
         )
         
-        self.character_file = os.getenv('CHARACTER_FILE', 'character.json')
-        self.character_data = self.load_character_data()
         self.mode = "chat"
-        self.session = None
-        self.memory_system = LocalMemory(self.character_data['profile']['name'])
+        self._latency_task: Optional[asyncio.Task] = None
+        self._character_watch_task: Optional[asyncio.Task] = None
+        # The snapshot is a deep copy, since commands edit nested sections in place
+        self._character_writer = AsyncJsonWriter(
+            self.character_file, lambda: copy.deepcopy(self.character_data), pretty=True
+        )
+        self.loop_monitor = LoopLagMonitor()
+        # A CharacterHost serves metrics for all of its bots itself
+        self.hosted = shared_session is not None
+        self._metrics_runner = None
+        self.provider = ProviderClient(self.character_data.setdefault('language_model', {}), shared_session)
+        self.memory_system = create_memory_system(self.character_data, shared_store)
+        self.token_counter = TokenCounter(self.character_data.get('language_model', {}).get('tokenizer', 'auto'))
+        self._ready_logged = False
+        self._setup_seconds = 0.0
+        self._init_done = time.perf_counter()
+        self.long_term = self._create_long_term_memory()
+        self._summary_tasks: Dict[int, asyncio.Task] = {}
+        # Summaries share the provider with replies, so only a few may be in flight at once
+        self._summary_slots = asyncio.Semaphore(int(
+            self.character_data.get('memory_system', {}).get('long_term', {}).get('max_concurrent_summaries', 1)))
+        self.character_revision = 0
+        self._prompt_cache: Dict[Tuple, str] = {}
+        self.command_index = CommandIndex(self.character_data.get('knowledge', {}).get('commands', []))
+        self.response_cache = self._create_response_cache()
+        self.feedback = self._create_feedback_store()
+        self.scheduler = GenerationScheduler(
+            self.generate_response,
+            max_concurrent=int(self.character_data.get('language_model', {}).get('max_concurrent', 4)),
+            on_queued=self._mark_busy,
+            on_started=self._clear_busy
+        )
         
+    def _create_response_cache(self) -> Optional[ResponseCache]:
+        """Create the response cache if language_model.response_cache is enabled"""
+        config = self.character_data.get('language_model', {}).get('response_cache', {})
+        if not self.settings.response_cache:
+            return None
+        path = None
+        if self.settings.response_cache_persist:
+            name = self.settings.slug
+            # Shard workers each keep their own cache file
+            suffix = f".worker{self.worker}" if self.worker is not None else ""
+            path = f"response_cache_{name}{suffix}.json"
+        return ResponseCache(path, ttl=float(config.get('ttl', 3600)), max_chars=int(config.get('max_chars', 1_000_000)))
+    
+    def _create_long_term_memory(self) -> Optional[LongTermMemory]:
+        """Create the summary/recall tier if memory_system.long_term is enabled"""
+        config = self.character_data.get('memory_system', {}).get('long_term', {})
+        if not self.settings.long_term:
+            return None
+        return LongTermMemory(self.character_data['profile']['name'],
+                              max_documents=int(config.get('max_documents', 500)), worker=self.worker)
+    
+    def _create_feedback_store(self) -> FeedbackStore:
+        config = self.character_data.get('output', {})
+        path = None
+        if self.settings.log_feedback:
+            name = self.settings.slug
+            # Shard workers each append to their own log
+            suffix = f".worker{self.worker}" if self.worker is not None else ""
+            path = f"feedback_{name}{suffix}.log"
+        return FeedbackStore(path, max_entries=int(config.get('reply_index_size', 500)),
+                             max_bytes=int(float(config.get('feedback_log_mb', 16)) * 1024 * 1024))
+    
+    def resource_usage(self) -> Dict:
+        """Snapshot of what this character is holding, for host reports"""
+        usage = {
+            'guilds': len(self.guilds),
+            'queue_depth': self.scheduler.queue_depth,
+            'in_flight': self.scheduler.in_flight,
+            'prompt_cache_entries': len(self._prompt_cache),
+            'summaries': len(self.long_term.summaries) if self.long_term else 0,
+            'archived_exchanges': self.long_term.document_count if self.long_term else 0,
+            'indexed_replies': len(self.feedback._replies),
+        }
+        memories = getattr(self.memory_system, 'memories', None)
+        if memories is None:
+            memories = getattr(self.memory_system, 'hot', None)
+        if memories is not None:
+            usage['cached_users'] = len(memories)
+            usage['cached_history_entries'] = sum(len(history) for history in memories.values())
+        if self.response_cache:
+            usage['response_cache_chars'] = self.response_cache.size_chars
+        return usage
+    
     def load_character_data(self):
         """Load character data from JSON file"""
-        try:
-            with open(self.character_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except FileNotFoundError:
-            logger.error(f"Character file {self.character_file} not found. Using template.")
-            with open('character_template.json', 'r', encoding='utf-8') as f:
-                return json.load(f)
+        return read_character_file(self.character_file)
     
     def save_character_data(self):
         """Save character data to JSON file"""
-        with open(self.character_file, 'w', encoding='utf-8') as f:
-            json.dump(self.character_data, f, indent=2, ensure_ascii=False)
+        self.invalidate_character_cache()
+        self._character_writer.save()
+    
+    async def reload_character_file(self) -> bool:
+        """Pick up edits another shard worker saved to the character file
+
+        Shard workers each hold their own copy of the character data, so a
+        worker rereads the file before applying an edit of its own (and
+        every 10 seconds) instead of overwriting the file from a stale copy.
+        """
+        # Our own unsaved edit must not be mistaken for a stale copy
+        await self._character_writer.flush()
+        loop = asyncio.get_running_loop()
+        try:
+            data = await loop.run_in_executor(None, read_json_file, self.character_file)
+            CharacterSettings(data)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Not reloading {self.character_file}: {e}")
+            return False
+        if data == self.character_data:
+            return False
+        self.character_data = data
+        self.provider.config = data.setdefault('language_model', {})
+        self.invalidate_character_cache()
+        logger.info(f"Reloaded {self.character_file} after an edit from another worker")
+        return True
+    
+    async def _watch_character_file(self):
+        while True:
+            await asyncio.sleep(10)
+            await self.reload_character_file()
+    
+    def invalidate_character_cache(self):
+        """Drop everything compiled from character data after an edit"""
+        self.character_revision += 1
+        try:
+            self.settings = CharacterSettings(self.character_data)
+        except CharacterError as e:
+            logger.error(f"Keeping previous settings, character data is invalid: {e}")
+        self._prompt_cache.clear()
+        self.command_index = CommandIndex(self.character_data.get('knowledge', {}).get('commands', []))
+        self.provider.reload()
     
     async def setup_hook(self):
-        """Initialize the HTTP session and load commands"""
-        self.session = aiohttp.ClientSession()
+        """Open the provider connection pools and load commands
+
+        Memory files and the tokenizer load in the background; nothing that
+        can wait until the first message is allowed to delay the login.
+        """
+        started = time.perf_counter()
+        await self.provider.start()
+        await self.memory_system.start()
+        asyncio.get_running_loop().run_in_executor(None, self.token_counter.load)
+        await self.feedback.start()
+        if self.long_term:
+            await self.long_term.start()
+        if self.response_cache:
+            self.response_cache.start_loading()
         await self.add_cog(CharacterCommands(self))
+        self.add_dynamic_items(FeedbackButton)
+        self._latency_task = asyncio.create_task(self._sample_gateway_latency())
+        if self.worker is not None:
+            self._character_watch_task = asyncio.create_task(self._watch_character_file())
+        self.loop_monitor.start()
+        if os.getenv('METRICS_PORT') and not self.hosted:
+            self._metrics_runner = await start_metrics_server(int(os.getenv('METRICS_PORT')),
+                                                              os.getenv('METRICS_HOST', '127.0.0.1'))
+        self._setup_seconds = time.perf_counter() - started
         logger.info(f"{self.character_data['profile']['name']} bot is starting up...")
         
     async def close(self):
         """Clean up when bot shuts down"""
-        if self.session:
-            await self.session.close()
+        if self._latency_task:
+            self._latency_task.cancel()
+        if self._character_watch_task:
+            self._character_watch_task.cancel()
+        self.loop_monitor.stop()
+        for task in list(self._summary_tasks.values()):
+            task.cancel()
+        if self._metrics_runner:
+            await self._metrics_runner.cleanup()
+        await self.provider.close()
+        await self.memory_system.close()
+        await self.feedback.close()
+        if self.long_term:
+            await self.long_term.close()
+        await self._character_writer.flush()
+        if self.response_cache:
+            await self.response_cache.ensure_loaded()
+            await asyncio.get_running_loop().run_in_executor(None, self.response_cache.save)
         await super().close()
         
+    def _log_time_to_ready(self) -> None:
+        """Log and export how long the bot took to come online, by phase"""
+        now = time.perf_counter()
+        if self.hosted:
+            # A CharacterHost can add this bot long after the process started
+            started = self._constructed
+            phases = {'character': self._init_done - self._constructed}
+        else:
+            started = BOOT_STARTED
+            phases = {'imports': IMPORTS_DONE - BOOT_STARTED, 'character': self._init_done - IMPORTS_DONE}
+        phases['setup'] = self._setup_seconds
+        # Whatever isn't accounted for was spent logging in and on the gateway handshake
+        phases['gateway'] = max(0.0, now - started - sum(phases.values()))
+        for phase, seconds in phases.items():
+            metrics.set_gauge('startup_seconds', seconds, phase=phase)
+        metrics.set_gauge('startup_seconds', now - started, phase='total')
+        logger.info(f"{self.settings.name} ready in {now - started:.2f}s (" +
+                    ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in phases.items()) + ")")
+
+    @staticmethod
+    def shard_of(message) -> int:
+        return message.guild.shard_id if message.guild else 0
+    
+    async def _sample_gateway_latency(self):
+        """Export heartbeat latency per shard every 15 seconds"""
+        while True:
+            await asyncio.sleep(15)
+            for shard_id, latency in getattr(self, 'latencies', None) or [(0, self.latency)]:
+                if math.isfinite(latency):
+                    metrics.set_gauge('gateway_latency_seconds', latency, shard=shard_id)
+    
     async def on_ready(self):
         logger.info(f'{self.character_data["profile"]["name"]} is online!')
+        # on_ready fires again after reconnects; only the first one is boot time
+        if not self._ready_logged:
+            self._ready_logged = True
+            self._log_time_to_ready()
         await self.change_presence(activity=discord.Game(name="in The Studio"))
         
     async def on_message(self, message):
+        metrics.incr('gateway_events_total', shard=self.shard_of(message), event='message')
         if message.author == self.user:
             return
             
@@ -143,10 +2622,10 @@ class StudioBot(commands.Bot):
         await self.process_commands(message)
         
         # Check for custom commands
-        for cmd in self.character_data.get('knowledge', {}).get('commands', []):
-            if message.content.lower() == cmd['command']:
-                await message.reply(cmd['response'])
-                return
+        response = self.command_index.match(message.content)
+        if response:
+            await message.reply(response)
+            return
         
         # Respond to mentions or DMs
         if self.user.mentioned_in(message) or isinstance(message.channel, discord.DMChannel):
@@ -155,10 +2634,39 @@ class StudioBot(commands.Bot):
             if content.startswith('!'):
                 return
                 
-            await self.generate_response(message, content)
+            self.scheduler.submit(message, content)
+    
+    async def _mark_busy(self, message):
+        """Show a queued user that their reply is waiting"""
+        try:
+            await message.add_reaction('⏳')
+        except discord.HTTPException:
+            pass
+    
+    async def _clear_busy(self, message):
+        try:
+            await message.remove_reaction('⏳', self.user)
+        except discord.HTTPException:
+            pass
     
     def build_system_prompt(self, user_data: Dict = None):
-        """Build system prompt from character data"""
+        """Return the system prompt, compiled once per character revision and mode"""
+        key = (self.character_revision, self.mode, bool(user_data))
+        prompt = self._prompt_cache.get(key)
+        if prompt is None:
+            metrics.incr('system_prompt_cache_total', result='miss')
+            prompt = self._compile_system_prompt(user_data)
+            self._prompt_cache[key] = prompt
+        else:
+            metrics.incr('system_prompt_cache_total', result='hit')
+        return prompt
+    
+    def _compile_system_prompt(self, user_data: Dict = None):
+        """Build system prompt from character data
+
+        Everything that depends on mode or user info comes last, so the
+        character section is a stable prefix for providers that cache it.
+        """
         char = self.character_data
         profile = char['profile']
         personality = char['personality']
@@ -236,151 +2744,367 @@ Remember to stay true to your character while being helpful and engaging."""
             return "No established relationships"
         return "\n".join([f"- {name}: {desc}" for name, desc in relationships.items()])
 
-    async def generate_response(self, message, content):
-        """Generate AI response using ElectronHub API"""
+    async def generate_response(self, message, content, regenerate=False, previous: Optional[ReplyRecord] = None):
+        """Generate AI response using ElectronHub API
+
+        previous is the reply being regenerated, when it is still indexed:
+        its prompt is reused and its turn in memory is replaced.
+        """
+        if previous and previous.content != content:
+            # Not a plain regeneration any more; treat it as a new message
+            previous = None
         try:
             async with message.channel.typing():
+                started = time.perf_counter()
                 user_id = message.author.id
-                recent_history = await self.memory_system.get_memories(user_id, limit=20)
-                
-                # Build user data for personalization
-                user_data = {
-                    'name': message.author.display_name,
-                    'id': user_id
-                }
+                # Loaded in the background since startup; usually done long before the first reply
+                if self.long_term:
+                    await self.long_term.ensure_loaded()
+                if self.response_cache:
+                    await self.response_cache.ensure_loaded()
+                if previous and previous.prompt and (previous.revision, previous.mode) == (self.character_revision, self.mode):
+                    messages = previous.prompt
+                    system_prompt = messages[0]['content']
+                else:
+                    history_limit = getattr(self.memory_system, 'max_history', 50)
+                    with metrics.timer('reply_stage_seconds', stage='history'):
+                        recent_history = await self.memory_system.get_memories(user_id, limit=history_limit)
+                    if self.long_term and recent_history:
+                        self.long_term.seed(user_id, recent_history)
+                    if previous and recent_history[-2:] == [{"role": "user", "content": previous.content},
+                                                            {"role": "assistant", "content": previous.response}]:
+                        # Don't show the model the reply it is replacing
+                        recent_history = recent_history[:-2]
+                    
+                    # Build user data for personalization
+                    user_data = {
+                        'name': message.author.display_name,
+                        'id': user_id
+                    }
+                    
+                    with metrics.timer('reply_stage_seconds', stage='prompt'):
+                        system_prompt = self.build_system_prompt(user_data)
+                        messages = self.build_context(user_id, system_prompt, recent_history, content)
                 
-                system_prompt = self.build_system_prompt(user_data)
+                info: Dict = {}
+                feedback = self.settings.feedback
+                # Buttons go out with the reply itself, so they cost no extra calls
+                view = feedback_view() if feedback == 'buttons' else None
+                sent: List[discord.Message] = []
+                cache_key = None
+                response = None
+                # DM replies are never cached; a prompt carrying the user's history,
+                # summary or recall only matches that same user again
+                if self.response_cache and not isinstance(message.channel, discord.DMChannel):
+                    personal = len(messages) > 2
+                    cache_key = ResponseCache.make_key(content, system_prompt, user_id if personal else None)
+                    # A regeneration means the cached reply wasn't wanted
+                    if not regenerate:
+                        response = self.response_cache.get(cache_key)
                 
-                messages = [{"role": "system", "content": system_prompt}]
-                messages.extend(recent_history)
-                messages.append({"role": "user", "content": content})
+                if response:
+                    info['model'] = 'cache'
+                    metrics.incr('response_cache_tokens_saved_total',
+                                 sum(self.token_counter.count_message(m) for m in messages) +
+                                 self.token_counter.count(response))
+                    with metrics.timer('reply_stage_seconds', stage='send'):
+                        sent = await self.send_long_message(message, response, view)
+                elif self.settings.stream:
+                    # Streaming posts and edits the reply itself
+                    with metrics.timer('reply_stage_seconds', stage='stream'):
+                        response, sent = await self.stream_reply(message, messages, view, info)
+                else:
+                    # Try primary model first
+                    with metrics.timer('reply_stage_seconds', stage='upstream'):
+                        response = await self.call_electronhub_api(messages, info=info)
+                    if response:
+                        with metrics.timer('reply_stage_seconds', stage='send'):
+                            sent = await self.send_long_message(message, response, view)
                 
-                # Try primary model first
-                response = await self.call_electronhub_api(messages)
+                if response and cache_key:
+                    self.response_cache.put(cache_key, response)
                 
                 if response:
-                    await self.memory_system.add_memory(user_id, "user", content)
-                    await self.memory_system.add_memory(user_id, "assistant", response)
-                    
-                    await self.send_long_message(message, response)
+                    with metrics.timer('reply_stage_seconds', stage='memory_write'):
+                        replaced = previous is not None and await self.memory_system.replace_last_memory(
+                            user_id, "assistant", previous.response, response)
+                        if not replaced:
+                            await self.memory_system.add_memory(user_id, "user", content)
+                            await self.memory_system.add_memory(user_id, "assistant", response)
+                        if self.long_term:
+                            self.long_term.add_exchange(user_id, content, response, replace=replaced)
                     
-                    # Add reactions for feedback
-                    sent_message = await message.channel.fetch_message(message.channel.last_message_id)
-                    await sent_message.add_reaction('🔄')  # Regenerate
-                    await sent_message.add_reaction('❤️')  # Good response
-                    await sent_message.add_reaction('💔')  # Bad response
+                    if sent:
+                        self.feedback.record_reply(ReplyRecord(
+                            [m.id for m in sent], message.id, message.channel.id, user_id, content, response,
+                            info.get('model'), self.mode, self.character_revision,
+                            prompt_tokens=sum(self.token_counter.count_message(m) for m in messages),
+                            completion_tokens=self.token_counter.count(response),
+                            origin=message, prompt=messages
+                        ))
+                    if feedback == 'reactions' and sent:
+                        with metrics.timer('reply_stage_seconds', stage='reactions'):
+                            await self.add_feedback_reactions(sent[-1])
+                    metrics.observe('reply_seconds', time.perf_counter() - started)
                     
         except Exception as e:
             logger.error(f"Error generating response: {e}")
             await message.reply("*Something went wrong. Try again?*")
     
-    async def call_electronhub_api(self, messages, use_fallback=False):
-        """Make API call to OpenAI-compatible endpoint"""
-        model_config = self.character_data.get('language_model', {})
-        
-        # Get API configuration
-        api_type = model_config.get('api_type', 'electronhub')
-        api_url = model_config.get('api_url', os.getenv('API_URL', 'https://api.electronhub.top'))
-        api_key = model_config.get('api_key', os.getenv('API_KEY'))
-        
-        # Support legacy ElectronHub config
-        if not api_key and 'electron_hub_proxy_key' in model_config:
-            api_key = model_config['electron_hub_proxy_key']
-        
-        model = model_config.get('fallback_model' if use_fallback else 'selected_model', 'gpt-3.5-turbo')
+    def context_budget(self) -> int:
+        """Prompt token budget that fits every model that may answer"""
+        return self.settings.context_budget
+    
+    def build_context(self, user_id: int, system_prompt: str, history: List[Dict], content: str) -> List[Dict]:
+        """Fill the prompt with the newest history that fits the token budget
+
+        With long-term memory on, the user's rolling summary and the archived
+        exchanges that best match the message go in first, if they fit.
+        """
+        count = self.token_counter.count_message
+        system_message = {"role": "system", "content": system_prompt}
+        user_message = {"role": "user", "content": content}
+        remaining = self.context_budget() - count(system_message) - count(user_message)
         
-        # Ensure proper URL format
-        if not api_url.endswith('/v1/chat/completions'):
-            api_url = api_url.rstrip('/') + '/v1/chat/completions'
+        long_term_messages = []
+        if self.long_term:
+            summary = self.long_term.summary(user_id)
+            if summary:
+                long_term_messages.append({"role": "system", "content": f"EARLIER CONVERSATION SUMMARY:\n{summary}"})
+            recall = self.settings.long_term_recall
+            # Exchanges still in the stored history aren't worth recalling
+            archived = self.long_term.next_seq(user_id) - len(history) // 2
+            recalled = self.long_term.search(user_id, content, recall, archived) if recall else []
+            if recalled:
+                metrics.incr('long_term_recalled_total', len(recalled))
+                long_term_messages.append({"role": "system",
+                                           "content": "RELEVANT PAST EXCHANGES:\n" + "\n\n".join(recalled)})
+            for extra in list(long_term_messages):
+                cost = count(extra)
+                if cost > remaining:
+                    long_term_messages.remove(extra)
+                else:
+                    remaining -= cost
         
-        url = api_url
+        kept = []
+        for entry in reversed(history):
+            cost = count(entry)
+            if cost > remaining:
+                break
+            kept.append(entry)
+            remaining -= cost
+        kept.reverse()
+        dropped = len(history) - len(kept)
         
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
+        messages = [system_message]
+        messages.extend(long_term_messages)
+        messages.extend(kept)
+        messages.append(user_message)
         
-        data = {
-            "model": model,
-            "messages": messages,
-            "temperature": 0.8,
-            "max_tokens": 1000,
-            "top_p": 0.9,
-            "frequency_penalty": 0.1,
-            "presence_penalty": 0.1
-        }
+        prompt_tokens = sum(count(m) for m in messages)
+        metrics.observe('prompt_tokens', prompt_tokens)
+        logger.info(f"Prompt for {user_id}: {prompt_tokens} tokens, {len(kept)} history messages, {dropped} dropped")
         
+        if self.long_term:
+            # Everything older than the turns in this prompt is due for summarizing
+            self._schedule_summary(user_id, self.long_term.next_seq(user_id) - len(kept) // 2)
+        return messages
+    
+    def _schedule_summary(self, user_id: int, before: int) -> None:
+        """Fold a batch of exchanges older than seq before into the user's summary, in the background"""
+        if user_id in self._summary_tasks:
+            return
+        batch = self.settings.summary_batch
+        pending = self.long_term.unsummarized(user_id, before)
+        if not pending or len(pending) < batch:
+            return
+        self._summary_tasks[user_id] = asyncio.create_task(
+            self._update_summary(user_id, pending[:batch * 4])
+        )
+    
+    async def _update_summary(self, user_id: int, exchanges: List[Tuple[int, str]]) -> None:
         try:
-            async with self.session.post(url, headers=headers, json=data) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    return result['choices'][0]['message']['content'].strip()
-                elif response.status == 429 and not use_fallback:
-                    # Rate limit - try fallback model
-                    logger.warning(f"Rate limit hit, trying fallback model")
-                    return await self.call_electronhub_api(messages, use_fallback=True)
-                else:
-                    error_text = await response.text()
-                    logger.error(f"API Error: {response.status} - {error_text}")
-                    if not use_fallback and model_config.get('fallback_model'):
-                        logger.info("Trying fallback model...")
-                        return await self.call_electronhub_api(messages, use_fallback=True)
-                    return None
+            transcript = "\n\n".join(text for _, text in exchanges)
+            prompt = [
+                {"role": "system", "content": "Summarize this conversation in a short paragraph, keeping names, facts and promises. Merge it with the existing summary if there is one."},
+                {"role": "user", "content": f"Existing summary:\n{self.long_term.summary(user_id) or 'None'}\n\nConversation:\n{transcript}"}
+            ]
+            # Summaries go to the cheaper fallback model
+            async with self._summary_slots:
+                summary = await self.call_electronhub_api(prompt, use_fallback=True)
+            if summary:
+                self.long_term.set_summary(user_id, exchanges[-1][0] + 1, summary)
+                metrics.incr('long_term_summaries_total')
         except Exception as e:
-            logger.error(f"API call failed: {e}")
-            if not use_fallback and model_config.get('fallback_model'):
-                logger.info("Trying fallback model due to exception...")
-                return await self.call_electronhub_api(messages, use_fallback=True)
-            return None
+            logger.error(f"Summary update failed: {e}")
+        finally:
+            self._summary_tasks.pop(user_id, None)
     
-    async def send_long_message(self, message, content):
-        """Split long messages for Discord's character limit"""
+    async def call_electronhub_api(self, messages, use_fallback=False, info: Optional[Dict] = None):
+        """Make API call to OpenAI-compatible endpoint, falling back if the primary fails
+
+        The model that answered is stored in info['model'] if info is given.
+        """
+        response, route = await self.provider.complete_routed(messages, use_fallback)
+        if route and info is not None:
+            info['model'] = route.name
+        return response
+    
+    async def stream_electronhub_api(self, messages, use_fallback=False, info: Optional[Dict] = None):
+        """Stream a completion from the OpenAI-compatible endpoint, yielding text deltas"""
+        for route in self.provider.candidate_routes(use_fallback):
+            model = route.name
+            received = False
+            try:
+                async for delta in self.provider.stream(messages, route):
+                    if not received and info is not None:
+                        info['model'] = model
+                    received = True
+                    yield delta
+                return
+            except ProviderError as e:
+                logger.warning(f"Model {model} stream failed: {e}")
+                if received:
+                    # Keep the partial reply rather than starting over
+                    return
+    
+    async def stream_reply(self, message, messages, view: Optional[discord.ui.View] = None,
+                           info: Optional[Dict] = None) -> Tuple[Optional[str], List[discord.Message]]:
+        """Post a streamed reply, editing it as tokens arrive
+
+        Returns the text and the messages it was posted as. The view, if
+        any, is attached to the last message with the final edit.
+        """
+        interval = self.settings.stream_edit_interval
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        last_edit = started
+        text = ""
+        sent: List[discord.Message] = []
+        shown: List[str] = []
+        
+        async for delta in self.stream_electronhub_api(messages, info=info):
+            text += delta
+            if not text.strip():
+                continue
+            now = loop.time()
+            if not sent:
+                await self._render_stream(message, text, sent, shown)
+                metrics.observe('stream_first_token_seconds', loop.time() - started)
+                last_edit = now
+            elif now - last_edit >= interval:
+                # Discord allows about five edits per five seconds per channel
+                await self._render_stream(message, text, sent, shown)
+                last_edit = now
+        
+        text = text.strip()
+        if not text:
+            return None, sent
+        await self._render_stream(message, text, sent, shown, view)
+        return text, sent
+    
+    async def _render_stream(self, message, text, sent, shown, view=None):
+        """Bring the posted messages in line with the text streamed so far"""
+        chunks = self.split_message(text.strip())
+        for i, chunk in enumerate(chunks):
+            extra = {'view': view} if view is not None and i == len(chunks) - 1 else {}
+            if i < len(sent):
+                if shown[i] != chunk or extra:
+                    await sent[i].edit(content=chunk, **extra)
+                    shown[i] = chunk
+            else:
+                new_message = await message.reply(chunk, **extra) if i == 0 else await message.channel.send(chunk, **extra)
+                sent.append(new_message)
+                shown.append(chunk)
+    
+    @staticmethod
+    def split_message(content: str) -> List[str]:
+        """Split text into chunks that fit Discord's character limit"""
         if len(content) <= 2000:
-            await message.reply(content)
-        else:
-            chunks = []
-            current_chunk = ""
-            
-            sentences = content.split('. ')
-            for sentence in sentences:
-                if len(current_chunk + sentence + '. ') > 1900:
-                    if current_chunk:
-                        chunks.append(current_chunk.strip())
-                        current_chunk = sentence + '. '
-                    else:
-                        chunks.append(sentence[:1900] + '...')
-                        current_chunk = '...' + sentence[1900:] + '. '
-                else:
-                    current_chunk += sentence + '. '
-            
+            return [content]
+        
+        chunks = []
+        current_chunk = ""
+        
+        sentences = content.split('. ')
+        for i, sentence in enumerate(sentences):
+            # Only re-add the separator that split() removed
+            if i < len(sentences) - 1:
+                sentence += '. '
+            if len(current_chunk + sentence) <= 1900:
+                current_chunk += sentence
+                continue
             if current_chunk:
                 chunks.append(current_chunk.strip())
-            
-            for i, chunk in enumerate(chunks):
-                if i == 0:
-                    await message.reply(chunk)
-                else:
-                    await message.channel.send(chunk)
-                await asyncio.sleep(0.5)
+            while len(sentence) > 1900:
+                chunks.append(sentence[:1900] + '...')
+                sentence = '...' + sentence[1900:]
+            current_chunk = sentence
+        
+        if current_chunk:
+            chunks.append(current_chunk.strip())
+        return chunks
+    
+    async def send_long_message(self, message, content, view: Optional[discord.ui.View] = None) -> List[discord.Message]:
+        """Split long messages for Discord's character limit
+
+        Chunks go out back to back: discord.py already holds each request
+        until the rate limit headers of its bucket allow it, so a fixed
+        delay between chunks would only add latency. The view, if any, is
+        attached to the last chunk.
+        """
+        chunks = self.split_message(content)
+        sent = []
+        for i, chunk in enumerate(chunks):
+            extra = {'view': view} if view is not None and i == len(chunks) - 1 else {}
+            if i == 0:
+                sent.append(await message.reply(chunk, **extra))
+            else:
+                sent.append(await message.channel.send(chunk, **extra))
+        return sent
+    
+    async def add_feedback_reactions(self, sent_message) -> None:
+        """Add the feedback reactions to a reply without waiting on each in turn"""
+        results = await asyncio.gather(*(sent_message.add_reaction(emoji) for emoji in FEEDBACK_EMOJI),
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning(f"Could not add feedback reaction: {result}")
     
     async def on_reaction_add(self, reaction, user):
         """Handle reaction-based feedback"""
+        message = reaction.message
+        metrics.incr('gateway_events_total', shard=self.shard_of(message), event='reaction')
         if user == self.user:
             return
             
-        message = reaction.message
         if message.author != self.user:
             return
             
-        emoji = str(reaction.emoji)
-        
+        await self.handle_feedback(message, str(reaction.emoji), user)
+    
+    async def handle_feedback(self, message, emoji: str, user):
+        """Act on feedback given on one of our replies, by reaction or button"""
+        await self.feedback.ensure_loaded()
+        self.feedback.record_feedback(message.id, user.id, emoji)
         if emoji == '🔄':
+            record = self.feedback.find(message.id)
+            if record:
+                # Before any await, so a second click can't regenerate the same reply again
+                self.feedback.forget(record)
+            origin = record and (record.origin or await self._fetch_origin(message.channel, record.origin_id))
+            if origin:
+                # Fast path: no history scan, and the reply's turn in memory gets replaced
+                await asyncio.gather(*(message.channel.get_partial_message(message_id).delete()
+                                       for message_id in record.message_ids), return_exceptions=True)
+                self.scheduler.submit(origin, record.content, regenerate=True, previous=record)
+                return
             # Regenerate response
             async for msg in message.channel.history(limit=10, before=message):
                 if msg.author != self.user and (self.user.mentioned_in(msg) or isinstance(message.channel, discord.DMChannel)):
                     content = msg.content.replace(f'<@{self.user.id}>', '').strip()
                     await message.delete()
-                    await self.generate_response(msg, content)
+                    self.scheduler.submit(msg, content, regenerate=True)
                     break
                     
         elif emoji == '❤️':
@@ -388,6 +3112,116 @@ Remember to stay true to your character while being helpful and engaging."""
             
         elif emoji == '💔':
             logger.info(f"Negative feedback for {self.character_data['profile']['name']}")
+    
+    @staticmethod
+    async def _fetch_origin(channel, message_id: int):
+        """Fetch the message a reply answered, for replies indexed before a restart"""
+        try:
+            return await channel.fetch_message(message_id)
+        except discord.HTTPException:
+            return None
+
+
+# Timing series shown by !stats, with the label that tells rows apart
+STATS_SERIES = [
+    ('reply_seconds', None, "Whole reply"),
+    ('reply_stage_seconds', 'stage', "Stage"),
+    ('upstream_ttfb_seconds', 'model', "Upstream TTFB"),
+    ('upstream_seconds', 'model', "Upstream total"),
+    ('stream_first_token_seconds', None, "First streamed token"),
+    ('scheduler_wait_seconds', None, "Queue wait"),
+    ('event_loop_lag_seconds', None, "Event loop lag"),
+]
+
+
+def format_stats() -> str:
+    """p50/p95/p99 of the timing series recorded in the current context"""
+    context = set((metric_labels.get() or {}).items())
+    lines = []
+    for name, label, title in STATS_SERIES:
+        for (series, labels), values in sorted(metrics.samples.items()):
+            if series != name or not context.issubset(labels):
+                continue
+            row = title
+            if label:
+                row = f"{title}: {dict(labels).get(label, '?')}"
+            p50, p95, p99 = (value * 1000 for value in Metrics.quantiles(values))
+            lines.append(f"{row[:28]:<28} {p50:>7.0f} {p95:>7.0f} {p99:>7.0f}  n={len(values)}")
+    if not lines:
+        return "No timings recorded yet."
+    header = f"{'(ms)':<28} {'p50':>7} {'p95':>7} {'p99':>7}"
+    return "```\n" + "\n".join([header] + lines) + "\n```"
+
+
+class ShardedStudioBot(StudioBot, commands.AutoShardedBot):
+    """StudioBot on discord.py's AutoShardedBot, one gateway connection per shard"""
+
+
+def bot_class(character_data: Dict):
+    """The bot class selected by gateway.sharded"""
+    return ShardedStudioBot if CharacterSettings(character_data).sharded else StudioBot
+
+
+async def fetch_recommended_shards(token: str) -> int:
+    """Ask Discord how many shards this bot should run"""
+    async with aiohttp.ClientSession() as session:
+        async with session.get('https://discord.com/api/v10/gateway/bot',
+                               headers={"Authorization": f"Bot {token}"}) as response:
+            response.raise_for_status()
+            return int((await response.json())['shards'])
+
+
+def run_shard_worker(character_file: str, token: str, shard_ids: List[int], shard_count: int,
+                     worker_index: int = 0) -> None:
+    """Entry point of a worker process running a subset of shards"""
+    if os.getenv('METRICS_PORT'):
+        # Each worker serves its own metrics on the next port up
+        os.environ['METRICS_PORT'] = str(int(os.environ['METRICS_PORT']) + worker_index)
+    character_data = read_character_file(character_file)
+    memory_config = character_data.setdefault('memory_system', {})
+    if memory_config.get('type') != 'sqlite':
+        # Only SQLite is safe to share between processes
+        logger.warning("Shard workers share memory through SQLite; using memory_system.type 'sqlite' "
+                       "(run --migrate-memories to import existing history)")
+        memory_config['type'] = 'sqlite'
+    # Other workers write to the same database, so a per-process history cache would go stale
+    memory_config['cache_users'] = 0
+    # An uncommitted batch would hold the write lock and stall every other worker's inserts
+    memory_config['flush_batch'] = 1
+    metric_labels.set({'worker': f"{shard_ids[0]}-{shard_ids[-1]}"})
+    bot = ShardedStudioBot(character_file, character_data=character_data, worker=worker_index,
+                           shard_ids=shard_ids, shard_count=shard_count)
+    bot.run(token)
+
+
+def run_sharded_workers(character_file: str, token: str, workers: int, shard_count: Optional[int]) -> None:
+    """Spread the bot's shards across worker processes"""
+    if not shard_count:
+        shard_count = asyncio.run(fetch_recommended_shards(token))
+    workers = max(1, min(workers, shard_count))
+    groups = [list(range(shard_count))[i::workers] for i in range(workers)]
+    logger.info(f"Running {shard_count} shards across {workers} worker processes")
+
+    import multiprocessing
+
+    context = multiprocessing.get_context('spawn')
+    processes = [
+        context.Process(target=run_shard_worker, args=(character_file, token, shard_ids, shard_count, index),
+                        name=f"shards-{shard_ids[0]}-{shard_ids[-1]}")
+        for index, shard_ids in enumerate(groups)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+            if process.exitcode:
+                logger.error(f"Worker {process.name} exited with code {process.exitcode}")
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
 
 
 class CharacterCommands(commands.Cog):
@@ -426,6 +3260,8 @@ class CharacterCommands(commands.Cog):
         try:
             if section in self.bot.character_data and field:
                 if value:
+                    if self.bot.worker is not None:
+                        await self.bot.reload_character_file()
                     # Handle list fields
                     if field in ['traits', 'likes', 'dislikes', 'aka_alias_nickname']:
                         self.bot.character_data[section][field] = [v.strip() for v in value.split(',')]
@@ -496,6 +3332,9 @@ class CharacterCommands(commands.Cog):
         """Reset your conversation history with the bot"""
         user_id = ctx.author.id
         await self.bot.memory_system.clear_memories(user_id)
+        if self.bot.long_term:
+            await self.bot.long_term.ensure_loaded()
+            self.bot.long_term.clear(user_id)
         await ctx.reply("🧹 Your conversation history has been reset!")
     
     @commands.command(name='model')
@@ -508,17 +3347,205 @@ class CharacterCommands(commands.Cog):
             await ctx.reply(f"Current model: {current}\nFallback model: {fallback}")
             return
         
+        if self.bot.worker is not None:
+            await self.bot.reload_character_file()
         self.bot.character_data['language_model']['selected_model'] = model
         self.bot.save_character_data()
         await ctx.reply(f"✅ Model changed to: {model}")
+    
+    @commands.command(name='stats')
+    @commands.has_permissions(administrator=True)
+    async def show_stats(self, ctx):
+        """Show latency percentiles (Admin only)"""
+        embed = discord.Embed(
+            title="Performance",
+            description=format_stats()[:4000],
+            color=discord.Color.blue()
+        )
+        await ctx.reply(embed=embed)
+
+
+# Multi-character hosting
+class CharacterHost:
+    """Run one StudioBot per character file in a single event loop
+
+    Bots share one pooled HTTP session and one SQLite memory store
+    (namespaced per character). The directory is rescanned periodically,
+    so character files can be added or removed without restarting the
+    others. Each bot's token comes from "discord_token" in its file or
+    the DISCORD_TOKEN_<FILE NAME> environment variable.
+    """
+
+    def __init__(self, directory: str, db_file: str = "memories_shared.db",
+                 scan_interval: float = 10.0, report_interval: float = 300.0):
+        self.directory = directory
+        self.db_file = db_file
+        self.scan_interval = scan_interval
+        self.report_interval = report_interval
+        self.bots: Dict[str, Tuple[StudioBot, asyncio.Task]] = {}
+        self._failed: Dict[str, float] = {}
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.store: Optional[SqliteStore] = None
+
+    def character_files(self) -> List[str]:
+        return sorted(
+            os.path.join(self.directory, name) for name in os.listdir(self.directory)
+            if name.endswith('.json')
+        )
+
+    @staticmethod
+    def token_for(path: str, character_data: Dict) -> Optional[str]:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        env_name = 'DISCORD_TOKEN_' + re.sub(r'\W', '_', stem).upper()
+        return character_data.get('discord_token') or os.getenv(env_name)
+
+    async def run(self) -> None:
+        self.session = create_pooled_session('shared', {'pool_size': 50})
+        self.store = SqliteStore(self.db_file)
+        await self.store.start()
+        metrics_runner = None
+        if os.getenv('METRICS_PORT'):
+            metrics_runner = await start_metrics_server(int(os.getenv('METRICS_PORT')),
+                                                        os.getenv('METRICS_HOST', '127.0.0.1'))
+        last_report = time.monotonic()
+        try:
+            while True:
+                await self.scan()
+                if time.monotonic() - last_report >= self.report_interval:
+                    self.report()
+                    last_report = time.monotonic()
+                await asyncio.sleep(self.scan_interval)
+        finally:
+            for path in list(self.bots):
+                await self.remove(path)
+            if metrics_runner:
+                await metrics_runner.cleanup()
+            await self.session.close()
+            await self.store.close()
+
+    async def scan(self) -> None:
+        """Start bots for new character files and stop bots whose file is gone"""
+        files = self.character_files()
+        for path in files:
+            if path in self.bots:
+                continue
+            mtime = os.path.getmtime(path)
+            if self._failed.get(path) == mtime:
+                # Unchanged since it last failed to load
+                continue
+            if not self.add(path):
+                self._failed[path] = mtime
+        for path in set(self.bots) - set(files):
+            await self.remove(path)
+
+    def add(self, path: str) -> bool:
+        try:
+            character_data = read_character_file(path)
+            bot = bot_class(character_data)(path, shared_session=self.session, shared_store=self.store,
+                                            character_data=character_data)
+        except Exception as e:
+            logger.error(f"Could not load character file {path}: {e}")
+            return False
+        token = self.token_for(path, bot.character_data)
+        if not token:
+            logger.error(f"No Discord token for {path}. Set discord_token in the file or DISCORD_TOKEN_<NAME>")
+            return False
+
+        # Everything this bot records is labelled with its character
+        name = bot.character_data['profile']['name']
+        context = copy_context()
+        context.run(metric_labels.set, {'character': name})
+        task = context.run(asyncio.get_running_loop().create_task, self._run_bot(bot, token))
+        self.bots[path] = (bot, task)
+        self._failed.pop(path, None)
+        logger.info(f"Hosting {name} from {path}")
+        return True
+
+    async def _run_bot(self, bot: StudioBot, token: str) -> None:
+        try:
+            await bot.start(token)
+        except Exception as e:
+            logger.error(f"{bot.character_data['profile']['name']} stopped: {e}")
+        finally:
+            if not bot.is_closed():
+                await bot.close()
+
+    async def remove(self, path: str) -> None:
+        bot, task = self.bots.pop(path)
+        logger.info(f"Stopping {bot.character_data['profile']['name']} ({path})")
+        await bot.close()
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    def report(self) -> None:
+        for bot, _ in self.bots.values():
+            usage = ', '.join(f"{key}={value}" for key, value in bot.resource_usage().items())
+            logger.info(f"{bot.character_data['profile']['name']}: {usage}")
+
+    async def migrate(self) -> None:
+        """Import every character's memories_<name>.json into the shared store"""
+        self.store = SqliteStore(self.db_file)
+        try:
+            for path in self.character_files():
+                try:
+                    character_data = read_json_file(path)
+                except (OSError, ValueError) as e:
+                    logger.error(f"Could not load character file {path}: {e}")
+                    continue
+                await migrate_json_memories(character_data, self.store)
+        finally:
+            await self.store.close()
 
 
 # Run the bot
 if __name__ == "__main__":
-    bot = StudioBot()
+    parser = argparse.ArgumentParser(description="Studio Bot")
+    parser.add_argument('--characters', default=os.getenv('CHARACTER_DIR'),
+                        help="Directory of character files to host in one process")
+    parser.add_argument('--migrate-memories', action='store_true',
+                        help="Import memories_<name>.json into the configured memory backend and exit")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="Spread the bot's shards across this many processes")
+    parser.add_argument('--feedback-report', metavar='LOG',
+                        help="Print reply and rating counts per model and mode from a feedback log and exit")
+    args = parser.parse_args()
+
+    if args.feedback_report:
+        print(json.dumps(feedback_report(args.feedback_report), indent=2))
+        sys.exit(0)
+
+    if args.characters:
+        host = CharacterHost(args.characters)
+        try:
+            asyncio.run(host.migrate() if args.migrate_memories else host.run())
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    character_file = os.getenv('CHARACTER_FILE', 'character.json')
+    character_data = read_character_file(character_file)
+
+    if args.migrate_memories:
+        asyncio.run(migrate_json_memories(character_data))
+        sys.exit(0)
+
     token = os.getenv('DISCORD_TOKEN')
+    gateway = character_data.get('gateway', {})
+    workers = args.workers or int(gateway.get('workers', 1))
     
     if not token:
         logger.error("No Discord token found! Set DISCORD_TOKEN in .env file")
+    elif workers > 1:
+        run_sharded_workers(character_file, token, workers, gateway.get('shard_count'))
     else:
+        options = {}
+        if CharacterSettings(character_data).sharded:
+            if gateway.get('shard_count'):
+                options['shard_count'] = int(gateway['shard_count'])
+            if gateway.get('shard_ids'):
+                options['shard_ids'] = list(gateway['shard_ids'])
+        bot = bot_class(character_data)(character_file, character_data=character_data, **options)
         bot.run(token)
\ No newline at end of file
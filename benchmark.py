@@ -0,0 +1,521 @@
+"""Offline benchmark for Studio Bot
+
+Drives StudioBot.on_message with synthetic users against a local fake
+OpenAI-compatible server and a mocked Discord channel, so throughput can be
+measured without a Discord token or a paid API. Each memory backend is also
+exercised directly for memory growth and write amplification.
+
+Results are printed (or written with --output) as JSON. Pass --baseline with
+an earlier result file to fail when a run regresses past --tolerance.
+
+    python benchmark.py
+    python benchmark.py --users 100 --messages 5 --latency 0.3 --stream
+    python benchmark.py --rate-limit 0.1 --output results.json
+    python benchmark.py --baseline results.json
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+import app
+
+BACKENDS = ['standard', 'append_log', 'sqlite']
+WORDS = ("the studio light falls across the desk while we talk about colour form "
+         "memory music and the long road home").split()
+
+# Fake provider
+class FakeProvider:
+    """Local OpenAI-compatible chat completions endpoint
+
+    Replies after a configurable latency, streams when asked to, and answers
+    a share of requests with 429 so retries and fallbacks get exercised.
+    """
+
+    def __init__(self, latency: float = 0.2, jitter: float = 0.1, reply_words: int = 60,
+                 chunk_delay: float = 0.01, rate_limit: float = 0.0, retry_after: float = 0.05,
+                 seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.reply_words = reply_words
+        self.chunk_delay = chunk_delay
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.throttled = 0
+        self.url: Optional[str] = None
+        self._runner: Optional[web.AppRunner] = None
+
+    def _reply_text(self) -> str:
+        return " ".join(self.random.choice(WORDS) for _ in range(self.reply_words)).capitalize() + "."
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        data = await request.json()
+        if self.random.random() < self.rate_limit:
+            self.throttled += 1
+            return web.json_response({"error": "rate limited"}, status=429,
+                                     headers={"Retry-After": str(self.retry_after)})
+        await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+        text = self._reply_text()
+        if not data.get('stream'):
+            return web.json_response({"choices": [{"message": {"role": "assistant", "content": text}}]})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for word in text.split(' '):
+            chunk = {"choices": [{"delta": {"content": word + ' '}}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(self.chunk_delay)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def start(self) -> None:
+        server = web.Application()
+        server.router.add_post('/v1/chat/completions', self.handle)
+        self._runner = web.AppRunner(server, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def close(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+
+# Fake Discord
+class FakeUser:
+    def __init__(self, user_id: int, name: str, bot: bool = False):
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+        self.mention = f"<@{user_id}>"
+
+    def mentioned_in(self, message) -> bool:
+        return self.mention in message.content
+
+
+class FakeMessage:
+    def __init__(self, message_id: int, channel: "FakeChannel", author: FakeUser, content: str):
+        self.id = message_id
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.guild = None
+        self.reactions: List[str] = []
+
+    async def reply(self, content: str = None, **kwargs) -> "FakeMessage":
+        return await self.channel.send(content, **kwargs)
+
+    async def add_reaction(self, emoji) -> None:
+        await self.channel.api_call('add_reaction')
+        self.reactions.append(str(emoji))
+
+    async def remove_reaction(self, emoji, member) -> None:
+        await self.channel.api_call('remove_reaction')
+
+    async def edit(self, content: str = None, **kwargs) -> "FakeMessage":
+        await self.channel.api_call('edit')
+        self.content = content
+        return self
+
+    async def delete(self) -> None:
+        await self.channel.api_call('delete')
+        self.channel.messages.pop(self.id, None)
+
+
+class FakeChannel:
+    """A text channel that counts REST calls and charges them a fixed latency"""
+
+    ids = itertools.count(1)
+
+    def __init__(self, channel_id: int, bot_user: FakeUser, rest_latency: float = 0.05):
+        self.id = channel_id
+        self.bot_user = bot_user
+        self.rest_latency = rest_latency
+        self.messages: Dict[int, FakeMessage] = {}
+        self.last_message_id: Optional[int] = None
+        self.calls: Dict[str, int] = {}
+
+    async def api_call(self, kind: str) -> None:
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        if self.rest_latency:
+            await asyncio.sleep(self.rest_latency)
+
+    def post(self, author: FakeUser, content: str) -> FakeMessage:
+        """Add a message as if it arrived over the gateway"""
+        message = FakeMessage(next(self.ids), self, author, content)
+        self.messages[message.id] = message
+        self.last_message_id = message.id
+        return message
+
+    async def send(self, content: str = None, **kwargs) -> FakeMessage:
+        await self.api_call('send')
+        return self.post(self.bot_user, content)
+
+    def get_partial_message(self, message_id: int) -> FakeMessage:
+        return self.messages.get(message_id) or FakeMessage(message_id, self, self.bot_user, "")
+
+    async def fetch_message(self, message_id: int) -> FakeMessage:
+        await self.api_call('fetch_message')
+        return self.messages[message_id]
+
+    async def history(self, limit: int = 100, before=None):
+        await self.api_call('history')
+        ordered = sorted(self.messages.values(), key=lambda m: m.id, reverse=True)
+        if before is not None:
+            ordered = [m for m in ordered if m.id < before.id]
+        for message in ordered[:limit]:
+            yield message
+
+    @asynccontextmanager
+    async def typing(self):
+        await self.api_call('typing')
+        yield
+
+
+class BenchBot(app.StudioBot):
+    """StudioBot that reports when each reply has finished"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waiters: Dict[int, asyncio.Future] = {}
+
+    async def process_commands(self, message):
+        # Prefix commands need a real connection state; only chat is measured
+        return
+
+    async def generate_response(self, message, content, **options):
+        try:
+            await super().generate_response(message, content, **options)
+        finally:
+            waiter = self.waiters.pop(message.author.id, None)
+            if waiter and not waiter.done():
+                waiter.set_result(time.perf_counter())
+
+
+# Helpers
+def character_data(backend: str, provider_url: str, args) -> Dict:
+    """The template character, pointed at the fake provider"""
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'character_template.json'),
+              encoding='utf-8') as f:
+        data = json.load(f)
+    data['profile']['name'] = "Bench"
+    data['memory_system'].update({'type': backend, 'max_history': args.max_history})
+    data['language_model'].update({
+        'api_url': provider_url,
+        'api_key': 'benchmark',
+        'selected_model': 'bench-primary',
+        'fallback_model': 'bench-fallback',
+        'stream': args.stream,
+        'stream_edit_interval': 0.2,
+        'max_concurrent': args.concurrency,
+        'backoff_base': 0.05,
+    })
+    data['language_model'].pop('response_cache', None)
+    data['output'] = {'feedback': args.feedback}
+    return data
+
+
+def bytes_written() -> Optional[int]:
+    """Bytes this process has passed to write() so far (Linux only)"""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def storage_bytes(directory: str) -> int:
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+               if name.startswith('memories_'))
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    p50, p95, p99 = app.Metrics.quantiles(values)
+    return {'p50_ms': round(p50 * 1000, 2), 'p95_ms': round(p95 * 1000, 2), 'p99_ms': round(p99 * 1000, 2)}
+
+
+def stage_percentiles() -> Dict[str, Dict[str, float]]:
+    """Per-stage reply timings recorded by the bot itself"""
+    stages = {}
+    for (name, labels), values in app.metrics.samples.items():
+        if name == 'reply_stage_seconds':
+            stages[dict(labels)['stage']] = percentiles(values)
+    return stages
+
+
+def counter_total(name: str) -> float:
+    return sum(value for (key, _), value in app.metrics.counters.items() if key == name)
+
+
+def synthetic_message(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+# Scenarios
+async def run_load(backend: str, args) -> Dict:
+    """Closed-loop chat: each user waits for a reply before sending again"""
+    app.metrics = app.Metrics(max_samples=100_000)
+    provider = FakeProvider(args.latency, args.jitter, args.reply_words, args.chunk_delay,
+                            args.rate_limit, args.retry_after, args.seed)
+    await provider.start()
+    bot_user = FakeUser(10_000, "Bench", bot=True)
+    bot = BenchBot(f"character_bench_{backend}.json",
+                   character_data=character_data(backend, provider.url, args))
+    bot._connection.user = bot_user
+    await bot.setup_hook()
+
+    channels = [FakeChannel(next(FakeChannel.ids), bot_user, args.rest_latency) for _ in range(args.channels)]
+    rng = random.Random(args.seed)
+    latencies: List[float] = []
+    failures = 0
+
+    async def chat(user_index: int) -> None:
+        nonlocal failures
+        user = FakeUser(user_index + 1, f"user{user_index}")
+        channel = channels[user_index % len(channels)]
+        for _ in range(args.messages):
+            message = channel.post(user, f"{bot_user.mention} {synthetic_message(rng, args.message_words)}")
+            waiter = asyncio.get_running_loop().create_future()
+            bot.waiters[user.id] = waiter
+            sent = time.perf_counter()
+            await bot.on_message(message)
+            try:
+                latencies.append(await asyncio.wait_for(waiter, args.timeout) - sent)
+            except asyncio.TimeoutError:
+                failures += 1
+            if args.think:
+                await asyncio.sleep(rng.uniform(0, args.think))
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(chat(i) for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+    finally:
+        await bot.close()
+        await provider.close()
+
+    calls: Dict[str, int] = {}
+    for channel in channels:
+        for kind, count in channel.calls.items():
+            calls[kind] = calls.get(kind, 0) + count
+    replies = len(latencies)
+    return {
+        'replies': replies,
+        'failures': failures,
+        'elapsed_s': round(elapsed, 3),
+        'messages_per_second': round(replies / elapsed, 2) if elapsed else 0.0,
+        'latency': percentiles(latencies),
+        'stages': stage_percentiles(),
+        'provider_requests': provider.requests,
+        'provider_throttled': provider.throttled,
+        'provider_retries': counter_total('provider_retries_total'),
+        'discord_calls': calls,
+        'discord_calls_per_reply': round(sum(calls.values()) / replies, 2) if replies else 0.0,
+    }
+
+
+async def run_storage(backend: str, directory: str, args) -> Dict:
+    """Write and read histories directly through the MemoryInterface
+
+    Memory is sampled with tracemalloc as users are added, and write
+    amplification is the bytes written to disk per byte of content stored.
+    """
+    data = character_data(backend, 'http://127.0.0.1', args)
+    rng = random.Random(args.seed)
+    checkpoints = sorted({max(1, args.storage_users * step // 4) for step in range(1, 5)})
+
+    tracemalloc.start()
+    baseline_memory = tracemalloc.get_traced_memory()[0]
+    written_before = bytes_written()
+    memory = app.create_memory_system(data)
+    await memory.start()
+
+    logical = 0
+    writes: List[float] = []
+    growth = []
+    user_id = 0
+    for checkpoint in checkpoints:
+        while user_id < checkpoint:
+            user_id += 1
+            for turn in range(args.turns):
+                content = synthetic_message(rng, args.message_words if turn % 2 == 0 else args.reply_words)
+                role = "user" if turn % 2 == 0 else "assistant"
+                logical += len(content.encode('utf-8')) + len(role)
+                started = time.perf_counter()
+                await memory.add_memory(user_id, role, content)
+                writes.append(time.perf_counter() - started)
+                if args.pace:
+                    await asyncio.sleep(args.pace)
+        growth.append({'users': checkpoint,
+                       'traced_bytes': tracemalloc.get_traced_memory()[0] - baseline_memory})
+
+    reads = []
+    for reader in range(1, user_id + 1):
+        started = time.perf_counter()
+        await memory.get_memories(reader, limit=args.max_history)
+        reads.append(time.perf_counter() - started)
+
+    await memory.close()
+    written_after = bytes_written()
+    peak = tracemalloc.get_traced_memory()[1] - baseline_memory
+    tracemalloc.stop()
+
+    written = None if written_before is None else written_after - written_before
+    return {
+        'users': user_id,
+        'entries': len(writes),
+        'logical_bytes': logical,
+        'bytes_written': written,
+        'write_amplification': round(written / logical, 2) if written is not None and logical else None,
+        'on_disk_bytes': storage_bytes(directory),
+        'write_latency': percentiles(writes),
+        'read_latency': percentiles(reads),
+        'memory_growth': growth,
+        'memory_bytes_per_user': round(growth[-1]['traced_bytes'] / user_id) if user_id else 0,
+        'peak_traced_bytes': peak,
+    }
+
+
+# Reporting
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+# (path into a result, True when higher is better)
+TRACKED = [
+    (('load', 'messages_per_second'), True),
+    (('load', 'latency', 'p95_ms'), False),
+    (('load', 'discord_calls_per_reply'), False),
+    (('storage', 'write_amplification'), False),
+    (('storage', 'memory_bytes_per_user'), False),
+]
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Describe every tracked figure that got worse by more than tolerance"""
+    regressions = []
+    for backend, current in results['backends'].items():
+        previous = baseline.get('backends', {}).get(backend)
+        if not previous:
+            continue
+        for path, higher_is_better in TRACKED:
+            new, old = current, previous
+            for part in path:
+                new = new.get(part) if isinstance(new, dict) else None
+                old = old.get(part) if isinstance(old, dict) else None
+            if not new or not old:
+                continue
+            change = (new - old) / old
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{backend} {'.'.join(path)}: {old} -> {new} ({change:+.0%})")
+    return regressions
+
+
+async def main(args) -> Dict:
+    results = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'config': vars(args),
+        'backends': {},
+    }
+    for backend in args.backends:
+        # Every backend starts from an empty directory, away from real memory files
+        with tempfile.TemporaryDirectory(prefix='studio-bench-') as directory:
+            previous = os.getcwd()
+            os.chdir(directory)
+            try:
+                result = {}
+                if not args.skip_load:
+                    result['load'] = await run_load(backend, args)
+                    for name in os.listdir(directory):
+                        os.remove(os.path.join(directory, name))
+                if not args.skip_storage:
+                    result['storage'] = await run_storage(backend, directory, args)
+            finally:
+                os.chdir(previous)
+        results['backends'][backend] = result
+        print(f"{backend}: done", file=sys.stderr)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline Studio Bot benchmark")
+    parser.add_argument('--backends', nargs='+', default=BACKENDS, choices=BACKENDS)
+    parser.add_argument('--users', type=int, default=20, help="Concurrent chatting users")
+    parser.add_argument('--messages', type=int, default=5, help="Messages per user")
+    parser.add_argument('--channels', type=int, default=4, help="Channels the users are spread over")
+    parser.add_argument('--concurrency', type=int, default=4, help="language_model.max_concurrent")
+    parser.add_argument('--think', type=float, default=0.0, help="Max pause between a user's messages (s)")
+    parser.add_argument('--timeout', type=float, default=60.0, help="Give up on a reply after this long (s)")
+    parser.add_argument('--stream', action='store_true', help="Stream replies")
+    parser.add_argument('--feedback', default='reactions', choices=['reactions', 'buttons', 'none'],
+                        help="output.feedback")
+    parser.add_argument('--latency', type=float, default=0.2, help="Fake provider latency (s)")
+    parser.add_argument('--jitter', type=float, default=0.05, help="Fake provider latency jitter (s)")
+    parser.add_argument('--chunk-delay', type=float, default=0.005, help="Delay between streamed chunks (s)")
+    parser.add_argument('--rate-limit', type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument('--retry-after', type=float, default=0.05, help="Retry-After sent with a 429 (s)")
+    parser.add_argument('--rest-latency', type=float, default=0.02, help="Latency of each Discord REST call (s)")
+    parser.add_argument('--message-words', type=int, default=12)
+    parser.add_argument('--reply-words', type=int, default=60)
+    parser.add_argument('--max-history', type=int, default=50, help="memory_system.max_history")
+    parser.add_argument('--storage-users', type=int, default=200, help="Users written in the storage run")
+    parser.add_argument('--turns', type=int, default=20, help="History entries written per user")
+    parser.add_argument('--pace', type=float, default=0.0, help="Pause between storage writes (s)")
+    parser.add_argument('--skip-load', action='store_true')
+    parser.add_argument('--skip-storage', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Write the JSON results here instead of stdout")
+    parser.add_argument('--baseline', help="Earlier results to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed regression, as a fraction")
+    parser.add_argument('--verbose', action='store_true', help="Keep the bot's own logging")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        # Per-message logs would skew both timings and bytes written
+        logging.disable(logging.WARNING)
+    os.environ.pop('METRICS_PORT', None)
+    results = asyncio.run(main(args))
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,55 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def breaker(monkeypatch, **options):
+    clock = Clock()
+    monkeypatch.setattr(app.time, 'monotonic', clock)
+    return app.CircuitBreaker("model", **options), clock
+
+
+def test_opens_after_consecutive_failures(monkeypatch):
+    b, _ = breaker(monkeypatch, failure_threshold=3)
+    b.record_failure()
+    b.record_failure()
+    b.record_success()
+    b.record_failure()
+    b.record_failure()
+    assert b.state == b.CLOSED and b.allow()
+    b.record_failure()
+    assert b.state == b.OPEN and not b.allow()
+
+
+def test_half_open_after_timeout_then_closes_on_success(monkeypatch):
+    b, clock = breaker(monkeypatch, failure_threshold=1, reset_timeout=30)
+    b.record_failure()
+    clock.now += 29
+    assert not b.allow()
+    clock.now += 1
+    assert b.allow() and b.state == b.HALF_OPEN
+    b.record_success()
+    assert b.state == b.CLOSED and b.failures == 0
+
+
+def test_failure_while_half_open_reopens(monkeypatch):
+    b, clock = breaker(monkeypatch, failure_threshold=5, reset_timeout=30)
+    for _ in range(5):
+        b.record_failure()
+    clock.now += 30
+    assert b.allow()
+    b.record_failure()
+    assert b.state == b.OPEN and not b.allow()
+    clock.now += 30
+    assert b.allow()
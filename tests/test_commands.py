@@ -0,0 +1,46 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+COMMANDS = [
+    {"command": "!hello", "response": "hi there", "aliases": ["!hey"]},
+    {"command": "!roll", "response": "rolling", "match": "prefix"},
+    {"command": "!rollback", "response": "undo", "match": "prefix"},
+    {"command": r"\bpizza\b", "response": "🍕", "match": "regex"},
+    {"command": "!broken", "response": "never", "match": "regex", "aliases": ["("]},
+    {"command": "!empty", "response": ""},
+]
+
+
+def test_exact_matches_ignore_case_and_include_aliases():
+    index = app.CommandIndex(COMMANDS)
+    assert index.match("!hello") == "hi there"
+    assert index.match("!HELLO") == "hi there"
+    assert index.match("!hey") == "hi there"
+    assert index.match("!hello there") is None
+
+
+def test_longest_prefix_wins():
+    index = app.CommandIndex(COMMANDS)
+    assert index.match("!roll 2d6") == "rolling"
+    assert index.match("!rollback now") == "undo"
+    assert index.match("!ROLLBACK") == "undo"
+
+
+def test_regex_matches_anywhere_and_bad_patterns_are_skipped():
+    index = app.CommandIndex(COMMANDS)
+    assert index.match("who wants Pizza tonight") == "🍕"
+    assert index.match("pizzas") is None
+    assert index.match("!broken") == "never"
+    assert len(index.patterns) == 2
+
+
+def test_commands_without_a_response_and_empty_messages_never_match():
+    index = app.CommandIndex(COMMANDS)
+    assert index.match("!empty") is None
+    assert index.match("") is None
+    assert index.match("nothing to see") is None
@@ -0,0 +1,68 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+@pytest.fixture(autouse=True)
+def in_tmp_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+
+def reply(index):
+    return app.ReplyRecord([index], 0, 0, 1, f"message {index}", f"reply {index} 🎨", "model", "chat")
+
+
+def test_index_is_rebuilt_from_the_tail_after_rotation():
+    async def write():
+        store = app.FeedbackStore("feedback.log", max_entries=50, max_bytes=16384)
+        await store.start()
+        for index in range(200):
+            store.record_reply(reply(index))
+            if index % 10 == 0:
+                store.record_feedback(index, 1, '❤️')
+                await store.flush()
+        await store.close()
+
+    asyncio.run(write())
+    assert not os.path.exists("feedback.log") or os.path.getsize("feedback.log") < 16384
+    assert os.path.exists("feedback.log.1")
+    with open("feedback.log", "ab") as f:
+        f.write('{"type":"reply","message_ids":[999],"response":"caf'.encode("utf-8") + "é".encode("utf-8")[:1])
+
+    async def reload():
+        store = app.FeedbackStore("feedback.log", max_entries=50, max_bytes=16384)
+        await store.start()
+        # Recorded before the index has been rebuilt; must still end up newest
+        store.record_reply(reply(200))
+        await store.ensure_loaded()
+        await store.close()
+        return store
+
+    store = asyncio.run(reload())
+    assert list(store._replies) == list(range(151, 201))
+    assert store.find(199).response == "reply 199 🎨"
+    with open("feedback.log", "rb") as f:
+        assert all(app.json_loads(line) for line in f)
+
+
+def test_iter_lines_backward_across_blocks():
+    lines = [f"line {i} {'x' * (i % 7)}".encode("utf-8") for i in range(100)]
+    with open("lines.txt", "wb") as f:
+        f.write(b"\n".join(lines) + b"\n")
+    assert list(app.iter_lines_backward("lines.txt", block_size=16)) == lines[::-1]
+
+
+def test_forget_drops_every_message_of_a_reply():
+    store = app.FeedbackStore(None)
+    record = app.ReplyRecord([1, 2], 0, 0, 1, "message", "reply", "model", "chat")
+    store.record_reply(record)
+    store.record_reply(reply(3))
+    store.forget(record)
+    assert store.find(1) is None and store.find(2) is None
+    assert store.find(3).response == "reply 3 🎨"
@@ -0,0 +1,141 @@
+import asyncio
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def write_history(memory, user_id, entries):
+    await memory.start()
+    for role, content in entries:
+        await memory.add_memory(user_id, role, content)
+    await memory.close()
+
+
+@pytest.fixture(autouse=True)
+def in_tmp_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+
+ENTRIES = [("user", "hello"), ("assistant", "café 🎨")]
+
+
+@pytest.mark.parametrize("cut", ["mid_record", "mid_character"])
+def test_append_log_survives_torn_last_record(cut):
+    run(write_history(app.AppendLogMemory("bot"), 1, ENTRIES))
+    with open("memories_bot.log", "rb") as f:
+        data = f.read()
+    last = data.rstrip(b"\n").rfind(b"\n") + 1
+    if cut == "mid_record":
+        torn = data[:last + 10]
+    else:
+        # Stop inside the four-byte emoji
+        torn = data[:data.index("🎨".encode("utf-8")) + 2]
+    with open("memories_bot.log", "wb") as f:
+        f.write(torn)
+
+    async def reopen():
+        memory = app.AppendLogMemory("bot")
+        await memory.start()
+        history = await memory.get_memories(1)
+        await memory.add_memory(1, "user", "again")
+        await memory.close()
+        return history
+
+    assert run(reopen()) == [{"role": "user", "content": "hello"}]
+
+    async def read_back():
+        memory = app.AppendLogMemory("bot")
+        await memory.start()
+        history = await memory.get_memories(1)
+        await memory.close()
+        return history
+
+    assert run(read_back()) == [{"role": "user", "content": "hello"}, {"role": "user", "content": "again"}]
+
+
+@pytest.mark.parametrize("memory_class", [app.LocalMemory, app.AppendLogMemory, app.SqliteMemory])
+def test_history_round_trip(memory_class):
+    run(write_history(memory_class("bot", max_history=2), 1, ENTRIES + [("user", "third")]))
+
+    async def read_back():
+        memory = memory_class("bot", max_history=2)
+        await memory.start()
+        history = await memory.get_memories(1)
+        await memory.close()
+        return history
+
+    assert run(read_back()) == [{"role": "assistant", "content": "café 🎨"}, {"role": "user", "content": "third"}]
+
+
+def test_long_term_torn_line_is_dropped_before_appending():
+    async def archive(texts):
+        memory = app.LongTermMemory("bot")
+        await memory.start()
+        await memory.ensure_loaded()
+        for text in texts:
+            memory.add_exchange(1, text, "reply")
+        await memory.close()
+        return memory
+
+    run(archive(["first"]))
+    with open("longterm_bot.log", "ab") as f:
+        f.write('{"u":1,"n":1,"d":"caf'.encode("utf-8") + "é".encode("utf-8")[:1])
+    run(archive(["second"]))
+
+    async def reload():
+        memory = app.LongTermMemory("bot")
+        await memory.start()
+        await memory.ensure_loaded()
+        await memory.close()
+        return memory
+
+    memory = run(reload())
+    assert memory.document_count == 2
+    assert memory.search(1, "second", 5, memory.next_seq(1)) == ["User: second\nYou: reply"]
+
+
+def test_record_log_compacts_to_snapshot():
+    state = {}
+
+    async def write():
+        log = app.RecordLog("records.log", snapshot=lambda: [{"k": k, "v": v} for k, v in state.items()],
+                            live=lambda: len(state))
+        await asyncio.get_running_loop().run_in_executor(None, log.replay, lambda r: None)
+        log.start()
+        for i in range(1500):
+            state["key"] = i
+            log.append({"k": "key", "v": i})
+        await log.close()
+
+    run(write())
+    with open("records.log", "rb") as f:
+        assert f.read() == b'{"k":"key","v":1499}\n'
+
+
+def test_sqlite_unbatched_writes_are_committed_at_once():
+    async def write():
+        memory = app.SqliteMemory("bot", commit_batch=1, commit_interval=60)
+        await memory.start()
+        await memory.add_memory(1, "user", "hello")
+        # Another process's connection must see the row without waiting for the commit loop
+        other = sqlite3.connect("memories_bot.db", timeout=0)
+        try:
+            other.execute("INSERT INTO memories (user_id, role, content) VALUES (2, 'user', 'hi')")
+            other.commit()
+            rows = other.execute("SELECT content FROM memories ORDER BY id").fetchall()
+        finally:
+            other.close()
+        await memory.close()
+        return rows
+
+    assert run(write()) == [("hello",), ("hi",)]
@@ -0,0 +1,92 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+def client(*routes, **config):
+    return app.ProviderClient({'routes': list(routes), 'explore': 0, **config})
+
+
+def counter(name, **labels):
+    return app.metrics.counters[app.Metrics._key(name, labels)]
+
+
+def fake_complete(behaviour):
+    """complete() stand-in: behaviour maps a model to (delay, reply); a None reply fails"""
+    async def complete(messages, route):
+        delay, reply = behaviour[route.model]
+        await asyncio.sleep(delay)
+        if reply is None:
+            raise app.ProviderError(f"{route.model} failed")
+        return reply
+    return complete
+
+
+def test_cost_prefers_untried_then_fast_reliable_routes():
+    fast, slow, flaky, dead, untried = (app.Route(name, 'default', name) for name in
+                                        ('fast', 'slow', 'flaky', 'dead', 'untried'))
+    fast.record(1.0)
+    slow.record(3.0)
+    flaky.record(1.0)
+    for _ in range(10):
+        flaky.record(None)
+    dead.record(None)
+    ranked = sorted([dead, slow, flaky, fast, untried], key=lambda route: route.cost)
+    assert [route.name for route in ranked] == ['untried', 'fast', 'slow', 'flaky', 'dead']
+    slow.weight = 4
+    assert slow.cost < fast.cost
+
+
+def test_candidate_routes_rank_preferred_before_fallback_routes():
+    provider = client({'model': 'a'}, {'model': 'b'}, {'model': 'small', 'fallback': True})
+    provider.routes['default:a'].record(2.0)
+    provider.routes['default:b'].record(1.0)
+    provider.routes['default:small'].record(0.1)
+    assert [route.model for route in provider.candidate_routes()] == ['b', 'a', 'small']
+    assert [route.model for route in provider.candidate_routes(use_fallback=True)] == ['small', 'b', 'a']
+
+
+def test_candidate_routes_skip_open_breakers():
+    provider = client({'model': 'a'}, {'model': 'b'}, breaker_threshold=1)
+    provider.breaker('default:a').record_failure()
+    assert [route.model for route in provider.candidate_routes()] == ['b']
+
+
+def test_failover_to_the_next_route():
+    provider = client({'model': 'a'}, {'model': 'b'})
+    provider.complete = fake_complete({'a': (0, None), 'b': (0, "from b")})
+    response, route = asyncio.run(provider.complete_routed([]))
+    assert (response, route.model) == ("from b", 'b')
+
+    provider.complete = fake_complete({'a': (0, None), 'b': (0, None)})
+    assert asyncio.run(provider.complete_routed([])) == (None, None)
+
+
+def test_hedge_win_is_counted_only_when_the_hedge_answers_first():
+    provider = client({'model': 'slow'}, {'model': 'quick'}, hedge_after=0.05)
+    provider.routes['default:slow'].record(0.1)
+    provider.routes['default:quick'].record(0.2)
+    hedges = counter('router_hedges_total', route='default:quick')
+    quick_wins = counter('router_hedge_wins_total', route='default:quick')
+    slow_wins = counter('router_hedge_wins_total', route='default:slow')
+
+    provider.complete = fake_complete({'slow': (1.0, "from slow"), 'quick': (0, "from quick")})
+    response, route = asyncio.run(provider.complete_routed([]))
+    assert (response, route.model) == ("from quick", 'quick')
+    assert counter('router_hedges_total', route='default:quick') == hedges + 1
+    assert counter('router_hedge_wins_total', route='default:quick') == quick_wins + 1
+
+    # Hedged, but the original request still answered first
+    provider.routes['default:slow'].latency = provider.routes['default:quick'].latency = None
+    provider.routes['default:slow'].record(0.1)
+    provider.routes['default:quick'].record(0.2)
+    provider.complete = fake_complete({'slow': (0.1, "from slow"), 'quick': (1.0, "from quick")})
+    response, route = asyncio.run(provider.complete_routed([]))
+    assert (response, route.model) == ("from slow", 'slow')
+    assert counter('router_hedges_total', route='default:quick') == hedges + 2
+    assert counter('router_hedge_wins_total', route='default:quick') == quick_wins + 1
+    assert counter('router_hedge_wins_total', route='default:slow') == slow_wins
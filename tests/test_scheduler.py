@@ -0,0 +1,88 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+def message(user_id, channel_id):
+    return SimpleNamespace(author=SimpleNamespace(id=user_id), channel=SimpleNamespace(id=channel_id))
+
+
+def run_scheduler(submit, max_concurrent=1):
+    """Submit jobs while the first one is held, then run everything; returns the handled calls in order"""
+    handled = []
+
+    async def main():
+        release = asyncio.Event()
+
+        async def handler(msg, content, **options):
+            handled.append((msg.author.id, msg.channel.id, content, options))
+            await release.wait()
+
+        scheduler = app.GenerationScheduler(handler, max_concurrent=max_concurrent)
+        submit(scheduler)
+        await asyncio.sleep(0)
+        release.set()
+        while scheduler.in_flight or scheduler.queue_depth:
+            await asyncio.sleep(0)
+
+    asyncio.run(main())
+    return handled
+
+
+def test_queued_messages_merge_within_a_channel():
+    def submit(scheduler):
+        scheduler.submit(message(1, 10), "first")
+        scheduler.submit(message(1, 10), "second")
+        scheduler.submit(message(1, 10), "third")
+
+    assert run_scheduler(submit) == [(1, 10, "first", {}), (1, 10, "second\nthird", {})]
+
+
+def test_messages_from_another_channel_are_not_merged():
+    def submit(scheduler):
+        scheduler.submit(message(1, 10), "busy")
+        scheduler.submit(message(1, 20), "private DM text")
+        scheduler.submit(message(1, 10), "public channel msg")
+
+    assert run_scheduler(submit) == [
+        (1, 10, "busy", {}), (1, 20, "private DM text", {}), (1, 10, "public channel msg", {}),
+    ]
+
+
+def test_jobs_with_options_are_queued_on_their_own():
+    def submit(scheduler):
+        scheduler.submit(message(1, 10), "busy")
+        scheduler.submit(message(1, 10), "hello")
+        scheduler.submit(message(1, 10), "hello", regenerate=True)
+        scheduler.submit(message(1, 10), "later")
+
+    assert [(content, options) for _, _, content, options in run_scheduler(submit)] == [
+        ("busy", {}), ("hello", {}), ("hello", {'regenerate': True}), ("later", {}),
+    ]
+
+
+def test_channels_take_turns():
+    def submit(scheduler):
+        scheduler.submit(message(9, 30), "busy")
+        for user_id in (1, 2, 3):
+            scheduler.submit(message(user_id, 10), f"user {user_id}")
+        scheduler.submit(message(4, 20), "user 4")
+
+    assert [user_id for user_id, *_ in run_scheduler(submit)] == [9, 1, 4, 2, 3]
+
+
+def test_one_reply_per_user_at_a_time():
+    def submit(scheduler):
+        scheduler.submit(message(1, 10), "first")
+        scheduler.submit(message(1, 20), "second")
+        scheduler.submit(message(2, 10), "other user")
+
+    # Two slots, but user 1's second job waits for the first to finish
+    assert [content for *_, content, _ in run_scheduler(submit, max_concurrent=2)] == [
+        "first", "other user", "second",
+    ]
@@ -0,0 +1,55 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+def settings(**language_model):
+    return app.CharacterSettings({'profile': {'name': 'Test Character'}, 'language_model': language_model})
+
+
+@pytest.mark.parametrize("value, expected", [
+    (True, True), (False, False), ("true", True), ("false", False), ("False", False),
+    ("1", True), ("0", False), (None, False), ("maybe", False),
+])
+def test_stream_flag_parses_strings_from_character_command(value, expected):
+    assert settings(stream=value).stream is expected
+
+
+def test_context_budget_per_model_and_bad_values():
+    assert settings(context_budget={'big': 32000, 'default': 4000}, selected_model='big').context_budget == 32000
+    assert settings(context_budget={'default': 4000}, selected_model='other').context_budget == 4000
+    # The fallback model may answer, so the prompt has to fit it too
+    assert settings(context_budget={'default': 6000, 'llama3:8b': 3000}, selected_model='gpt-4o',
+                    fallback_model='llama3:8b').context_budget == 3000
+    routes = [{'model': 'big'}, {'model': 'small', 'fallback': True}]
+    assert settings(context_budget={'big': 32000, 'small': 8000}, selected_model='big', routes=routes).context_budget == 8000
+    assert settings(context_budget='lots').context_budget == 6000
+
+
+def test_profile_name_is_required():
+    with pytest.raises(app.CharacterError):
+        app.CharacterSettings({'profile': {}})
+    with pytest.raises(app.CharacterError):
+        app.CharacterSettings({'profile': {'name': 'A'}, 'output': []})
+
+
+def test_feature_flags_parse_strings():
+    data = {
+        'profile': {'name': 'Test Character'},
+        'language_model': {'summarize_dropped': 'false', 'response_cache': {'enabled': 'true', 'persist': 'false'}},
+        'memory_system': {'long_term': {'enabled': 'false'}},
+        'output': {'log_feedback': 'false'},
+        'gateway': {'sharded': 'false'},
+    }
+    flags = app.CharacterSettings(data)
+    assert flags.long_term is False
+    assert flags.response_cache is True and flags.response_cache_persist is False
+    assert flags.log_feedback is False
+    assert flags.sharded is False
+    assert app.bot_class(data) is app.StudioBot
+    assert app.CharacterSettings({'profile': {'name': 'Test Character'}}).log_feedback is True
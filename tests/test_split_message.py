@@ -0,0 +1,30 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+split_message = app.StudioBot.split_message
+
+
+def test_short_messages_are_sent_whole():
+    assert split_message("hello. world") == ["hello. world"]
+    assert split_message("x" * 2000) == ["x" * 2000]
+
+
+def test_long_messages_split_between_sentences():
+    sentences = [f"Sentence {i} " + "word " * 40 for i in range(40)]
+    chunks = split_message(". ".join(sentences))
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 2000 for chunk in chunks)
+    assert all(chunk.endswith(".") for chunk in chunks[:-1])
+    assert chunks[1].startswith("Sentence")
+    assert " ".join(chunks).split() == ". ".join(sentences).split()
+
+
+def test_sentences_longer_than_a_message_are_cut_with_ellipses():
+    chunks = split_message("x" * 5000)
+    assert all(len(chunk) <= 2000 for chunk in chunks)
+    assert chunks[0].endswith("...") and chunks[1].startswith("...")
+    assert "".join(chunk.strip(".") for chunk in chunks) == "x" * 5000